@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+""" Measures the cost of the pool's bookkeeping operations at different pool
+sizes. Each operation should take roughly the same time regardless of how
+many objects are in the pool.
+
+Usage:
+
+    python3 benchmarks/bench_bookkeeping.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyresourcepool.pyresourcepool import ResourcePool  # noqa: E402
+
+SIZES = (10, 1000, 100000)
+OPERATIONS = 10000
+
+
+class Resource(object):
+    pass
+
+
+def per_op_usec(func, count):
+    start = time.perf_counter()
+    func(count)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def bench_acquire_return(pool, count):
+    def run(n):
+        get = pool.get_resource_unmanaged
+        put = pool.return_resource
+        for i in range(n):
+            put(get())
+    return per_op_usec(run, count)
+
+
+def bench_add_remove(pool, count):
+    extra = [Resource() for i in range(count)]
+
+    def run_add(n):
+        for o in extra[:n]:
+            pool.add(o)
+
+    def run_remove(n):
+        for o in extra[:n]:
+            pool.remove(o)
+    return per_op_usec(run_add, count), per_op_usec(run_remove, count)
+
+
+def main():
+    print("{:>8} {:>16} {:>10} {:>10}".format(
+        "size", "acquire+return", "add", "remove"))
+    for size in SIZES:
+        pool = ResourcePool([Resource() for i in range(size)])
+        acquire_return = bench_acquire_return(pool, OPERATIONS)
+        add, remove = bench_add_remove(pool, OPERATIONS)
+        print("{:>8} {:>13.2f} us {:>7.2f} us {:>7.2f} us".format(
+            size, acquire_return, add, remove))
+
+
+if __name__ == '__main__':
+    main()
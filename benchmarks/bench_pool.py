@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+""" Throughput and latency of the pools under different workloads. Each
+workload reports operations (acquire + return) per second and the p50/p99
+time callers waited for a resource.
+
+Results can be saved as a baseline and later runs compared against it, eg.
+before and after a change:
+
+    python3 benchmarks/bench_pool.py --save baseline.json
+    python3 benchmarks/bench_pool.py --compare baseline.json
+
+Use --quick for a shorter run and --only to run the workloads whose name
+contains the given text. Numbers depend on the machine, only compare runs
+made on the same one.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from threading import Barrier, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyresourcepool.asyncpool import AsyncResourcePool  # noqa: E402
+from pyresourcepool.metrics import Histogram  # noqa: E402
+from pyresourcepool.pyresourcepool import ResourcePool  # noqa: E402
+from pyresourcepool.shardedpool import ShardedResourcePool  # noqa: E402
+
+
+class Resource(object):
+    pass
+
+
+def reset(obj):
+    """ A cheap return callback. """
+    obj.uses = 0
+
+
+def result(ops, elapsed, waits):
+    snapshot = waits.snapshot()
+    return {
+        'ops_per_sec': ops / elapsed,
+        'p50_wait_us': (snapshot['p50'] or 0) * 1e6,
+        'p99_wait_us': (snapshot['p99'] or 0) * 1e6,
+    }
+
+
+def run_threads(pool, threads, ops_per_thread):
+    """ Each thread gets and returns a resource 'ops_per_thread' times,
+    timing how long each get took.
+    """
+    histograms = [Histogram() for i in range(threads)]
+    barrier = Barrier(threads + 1)
+
+    def worker(waits):
+        get = pool.get_resource_unmanaged
+        put = pool.return_resource
+        clock = time.perf_counter
+        barrier.wait()
+        for i in range(ops_per_thread):
+            start = clock()
+            obj = get()
+            waits.record(clock() - start)
+            put(obj)
+
+    workers = [Thread(target=worker, args=(h,)) for h in histograms]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    waits = Histogram()
+    for h in histograms:
+        waits.merge(h)
+    return result(threads * ops_per_thread, elapsed, waits)
+
+
+def bench_uncontended(scale):
+    pool = ResourcePool([Resource() for i in range(10)])
+    return run_threads(pool, 1, 100000 // scale)
+
+
+def bench_contended(threads, resources, **kwargs):
+    def run(scale):
+        pool = ResourcePool([Resource() for i in range(resources)], **kwargs)
+        return run_threads(pool, threads, 20000 // scale)
+    return run
+
+
+def bench_sharded(threads, resources):
+    def run(scale):
+        pool = ShardedResourcePool([Resource() for i in range(resources)], stripes=8)
+        return run_threads(pool, threads, 20000 // scale)
+    return run
+
+
+def bench_callbacks(scale):
+    pool = ResourcePool([Resource() for i in range(8)], return_callback=reset,
+                        callback_workers=4)
+    stats = run_threads(pool, 8, 5000 // scale)
+    pool.close()
+    return stats
+
+
+def bench_churn(scale):
+    """ add() and remove() of objects in a pool of 100k objects, while other
+    threads get and return resources. The latencies are of add() + remove().
+    """
+    pool = ResourcePool([Resource() for i in range(100000)])
+    extra = [Resource() for i in range(20000 // scale)]
+    stop = []
+
+    def users():
+        while not stop:
+            pool.return_resource(pool.get_resource_unmanaged())
+    background = [Thread(target=users) for i in range(4)]
+    for t in background:
+        t.start()
+    waits = Histogram()
+    start = time.perf_counter()
+    for obj in extra:
+        t = time.perf_counter()
+        pool.add(obj)
+        pool.remove(obj)
+        waits.record(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    stop.append(True)
+    for t in background:
+        t.join()
+    return result(len(extra), elapsed, waits)
+
+
+def bench_asyncio(scale):
+    async def main():
+        pool = AsyncResourcePool([Resource() for i in range(4)])
+        waits = Histogram()
+        ops = 5000 // scale
+
+        async def worker():
+            for i in range(ops):
+                start = time.perf_counter()
+                async with pool.get_resource():
+                    waits.record(time.perf_counter() - start)
+                    await asyncio.sleep(0)
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for i in range(32)])
+        return result(32 * ops, time.perf_counter() - start, waits)
+    return asyncio.run(main())
+
+
+def workloads():
+    return [
+        ('uncontended', bench_uncontended),
+        ('contended 8 threads, 2 resources', bench_contended(8, 2)),
+        ('contended 64 threads, 64 resources', bench_contended(64, 64)),
+        ('contended fair 8 threads, 2 resources', bench_contended(8, 2, fair=True)),
+        ('contended metrics 8 threads, 2 resources',
+         bench_contended(8, 2, metrics=True)),
+        ('sharded 64 threads, 64 resources', bench_sharded(64, 64)),
+        ('return callbacks 8 threads, 8 resources', bench_callbacks),
+        ('add/remove churn, 100k objects', bench_churn),
+        ('asyncio 32 tasks, 4 resources', bench_asyncio),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true', help="run 10x fewer operations")
+    parser.add_argument('--only', help="only run workloads with this in their name")
+    parser.add_argument('--save', metavar='FILE', help="save the results as JSON")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with results saved by --save")
+    args = parser.parse_args()
+    scale = 10 if args.quick else 1
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print("{:<44} {:>12} {:>10} {:>10}".format("workload", "ops/s", "p50 us", "p99 us"))
+    results = {}
+    for name, bench in workloads():
+        if args.only and args.only not in name:
+            continue
+        stats = bench(scale)
+        results[name] = stats
+        line = "{:<44} {:>12.0f} {:>10.1f} {:>10.1f}".format(
+            name, stats['ops_per_sec'], stats['p50_wait_us'], stats['p99_wait_us'])
+        if name in baseline:
+            change = stats['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1
+            line += "  {:+.1%} ops/s".format(change)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'quick': args.quick,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
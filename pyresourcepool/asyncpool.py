@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+""" asyncio version of the python object resource pool.
+"""
+
+import asyncio
+import functools
+import inspect
+import time
+import traceback
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from pyresourcepool.pyresourcepool import (
+    CALLBACK_ATTRIBUTE,
+    AllResourcesRemoved,
+    ObjectAlreadyInPool,
+    ObjectNotInPool,
+    ResourceTimeout,
+    _NO_RESOURCE,
+    _Resource,
+)
+from pyresourcepool.strategies import FifoStrategy
+
+
+def _is_async_callable(callback):
+    """ True if calling 'callback' gives an awaitable rather than running it,
+    this sees through functools.partial and objects with 'async def __call__'.
+    """
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+    return asyncio.iscoroutinefunction(callback) or \
+        asyncio.iscoroutinefunction(getattr(callback, '__call__', None))
+
+
+class AsyncResourcePool(object):
+    def __init__(self, objects, return_callback=None):
+        """
+        Instantiate with a list of objects you want in the resource pool.
+
+        This pool has the same semantics as ResourcePool but is meant to be
+        used from coroutines running in a single asyncio event loop. Waiting
+        for a resource is done on a future so no threads are involved.
+
+        'return_callback' is run on an object before it is returned to the
+        pool without making the coroutine that returned the object wait for
+        it. It can be a coroutine function, in which case it is run as a
+        task on the event loop, or a plain function, in which case it is run
+        in the event loop's default executor so it doesn't block the loop.
+        Success is measured by no exceptions being raised. If an exception is
+        raised then the object will be removed from the pool rather than
+        being returned as an available resource.
+        """
+        # the _Resource record of each object in the pool, dropped once the
+        # object has left the pool and isn't checked out, as for ResourcePool
+        self._records = {}
+        self._active = 0
+        self._available = FifoStrategy()
+        # futures of the coroutines waiting for a resource, oldest first
+        self._waiters = deque()
+        self._return_callback = return_callback
+        self._timeouts = 0
+        # keep a reference to the running callback tasks so they aren't
+        # garbage collected before they complete
+        self._callback_tasks = set()
+        # as for ResourcePool, duplicates in 'objects' are only added once
+        self.add(list(OrderedDict((id(o), o) for o in objects).values()))
+
+    def all_removed(self):
+        return self._active == 0
+
+    def add(self, obj):
+        """
+        Adds new objects to the pool, 'obj' can be a single object or a list of
+        objects and new objects are added to the end of the available resources.
+        """
+        if type(obj) is not list:
+            obj = [obj]
+        for o in obj:
+            if o is None:
+                raise ValueError("None can't be a resource, it means 'no resource'.")
+            if id(o) in self._records:
+                raise ObjectAlreadyInPool("Object is already in the pool.")
+            self._records[id(o)] = _Resource(o, time.monotonic())
+            self._available.append(o)
+            self._active += 1
+        self._wakeup_waiters()
+
+    def remove(self, obj):
+        """
+        Removes an object from the pool so that it can't be handed out as an
+        available resource again. If the object passed in is not in the pool
+        an ObjectNotInPool exception is raised.
+        """
+        self._remove(obj, gone=False)
+
+    def _remove(self, obj, gone):
+        """ remove(), 'gone' being True if the caller has the object and
+        won't return it so it can be dropped straight away.
+        """
+        rec = self._records.get(id(obj))
+        if rec is None:
+            raise ObjectNotInPool("Object is not in the list of pool objects.")
+        if not rec.removed:
+            rec.removed = True
+            self._active -= 1
+        if gone or obj in self._available:
+            self._available.discard(obj)
+            del self._records[id(obj)]
+        if self.all_removed():
+            while self._waiters:
+                fut = self._waiters.popleft()
+                if not fut.done():
+                    fut.set_exception(AllResourcesRemoved(
+                        "All resources have been removed. Further use of "
+                        "the resource pool is void unless new resources are"
+                        "added."))
+            raise AllResourcesRemoved(
+                "All resources have been removed. "
+                "Further use of the resource pool is void.")
+
+    def _wakeup_waiters(self):
+        """ Hands available objects to the oldest waiters. """
+        while self._waiters and self._available:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(self._available.take())
+
+    def _expire_waiter(self, fut):
+        if not fut.done():
+            self._timeouts += 1
+            fut.set_exception(ResourceTimeout(
+                "Timed out waiting for a resource from the pool."))
+
+    async def get_resource_unmanaged(self, block=True, timeout=None, deadline=None):
+        """
+        Gets a resource from the pool but in an "unmanaged" fashion. It is
+        up to you to return the resource to the pool by calling
+        return_resource().
+
+        'block', 'timeout' and 'deadline' behave as they do for
+        ResourcePool.get_resource_unmanaged(), 'deadline' being a
+        time.monotonic() value.
+
+        If the awaiting task is cancelled the resource is never lost: if it
+        was handed to the task at the same time as it was cancelled, it is
+        put straight back into the pool.
+        """
+        obj = await self._get(block, timeout, deadline)
+        return None if obj is _NO_RESOURCE else obj
+
+    async def _get(self, block, timeout, deadline):
+        """ get_resource_unmanaged() but returns _NO_RESOURCE rather than None
+        when there is nothing available.
+        """
+        if self.all_removed():
+            raise AllResourcesRemoved(
+                "All resources have been removed. Further use of "
+                "the resource pool is void unless new resources are"
+                "added.")
+        if self._available:
+            return self._available.take()
+        if not block:
+            return _NO_RESOURCE
+
+        if timeout is not None:
+            expires = time.monotonic() + timeout
+            if deadline is not None:
+                expires = min(expires, deadline)
+        else:
+            expires = deadline
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._waiters.append(fut)
+        timer = None
+        if expires is not None:
+            timer = loop.call_later(max(expires - time.monotonic(), 0),
+                                    self._expire_waiter, fut)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                # we were handed an object just as we were cancelled
+                self.return_resource(fut.result(), force=True)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            try:
+                self._waiters.remove(fut)
+            except ValueError:
+                # already taken off the queue when it was handed an object
+                pass
+
+    def return_resource(self, obj, force=False):
+        """ Returns a resource to the pool, see ResourcePool.return_resource().
+
+        If a return callback applies to the object it is scheduled as a task
+        on the running event loop and this method returns straight away.
+        """
+        if id(obj) not in self._records:
+            raise ObjectNotInPool("Object {} not a member of the pool".format(str(obj)))
+
+        if not force:
+            callback = None
+            if hasattr(obj, CALLBACK_ATTRIBUTE) and \
+                    getattr(obj, CALLBACK_ATTRIBUTE) is not None:
+                callback = getattr(obj, CALLBACK_ATTRIBUTE)
+                # strip the callback attribute from the object
+                delattr(obj, CALLBACK_ATTRIBUTE)
+            elif self._return_callback:
+                callback = self._return_callback
+            if callback:
+                task = asyncio.get_running_loop().create_task(
+                    self._run_return_callback(obj, callback))
+                self._callback_tasks.add(task)
+                task.add_done_callback(self._callback_tasks.discard)
+                return
+
+        rec = self._records[id(obj)]
+        if rec.removed:
+            del self._records[id(obj)]
+        else:
+            self._available.append(obj)
+            self._wakeup_waiters()
+
+    async def _run_return_callback(self, obj, callback):
+        """ Runs the return callback for an object as a task and returns the
+        object to the pool, or removes it if the callback raised an exception.
+        """
+        try:
+            if _is_async_callable(callback):
+                result = callback(obj)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, callback, obj)
+            # a plain function can still hand back an awaitable to be run
+            if inspect.isawaitable(result):
+                await result
+            self.return_resource(obj, force=True)
+        except Exception:
+            traceback.print_exc()
+            try:
+                self._remove(obj, gone=True)
+            except AllResourcesRemoved:
+                # the waiters have already been told, there is no one to
+                # raise this to from a task
+                pass
+
+    @asynccontextmanager
+    async def get_resource(self, block=True, timeout=None, deadline=None):
+        """
+        Intended to be used in an 'async with' statement or a
+        contextlib.AsyncExitStack.
+
+        Returns an object from the pool and waits if necessary. If 'block' is
+        False, then None is returned if the pool has been depleted.
+
+        Example useage:
+
+            async with pool.get_resource() as r:
+                await do_stuff(r)
+            # at this point, outside the with block, the resource has
+            # been returned to the pool.
+        """
+        obj = _NO_RESOURCE
+        try:
+            obj = await self._get(block, timeout, deadline)
+            yield None if obj is _NO_RESOURCE else obj
+        finally:
+            if obj is not _NO_RESOURCE:
+                self.return_resource(obj)
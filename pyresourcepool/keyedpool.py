@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+""" A resource pool holding a separate set of objects per key (eg. per backend
+host) with a cap on the total number of objects across all of the keys.
+"""
+
+import functools
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Event, RLock, Thread
+
+from pyresourcepool.pyresourcepool import (
+    ObjectAlreadyInPool,
+    ObjectNotInPool,
+    PoolClosed,
+    ResourcePool,
+    _reaper,
+)
+
+# counters of ResourcePool.stats() that are summed over the keys
+_SUMMED_STATS = ('size', 'available', 'checked_out', 'in_callback', 'removed',
+                 'waiters', 'acquires', 'timeouts', 'callback_failures', 'rejected')
+
+
+class _KeyedSubPool(ResourcePool):
+    """ The pool of objects for a single key. It shares its lock with the
+    KeyedResourcePool and every other key, which is what lets the global cap
+    be checked and idle objects be taken from other keys atomically.
+    """
+    _own_reaper = False
+
+    def __init__(self, parent, key, **kwargs):
+        self._parent = parent
+        self.key = key
+        ResourcePool.__init__(self, **kwargs)
+
+    def _make_lock(self):
+        return self._parent._lock
+
+    def _register(self, o):
+        if id(o) in self._parent._owners and self._parent._owners[id(o)] is not self:
+            raise ObjectAlreadyInPool("Object is already in the pool for another key.")
+        ResourcePool._register(self, o)
+        self._parent._owners[id(o)] = self
+
+    def _drop(self, rec):
+        ResourcePool._drop(self, rec)
+        del self._parent._owners[id(rec.obj)]
+
+    def _growth_room(self, wanted):
+        room = ResourcePool._growth_room(self, wanted)
+        if room < wanted:
+            # not enough to be of any use, don't evict anything for it
+            return room
+        return self._parent._make_room(self, room)
+
+    def _capacity_freed(self):
+        self._parent._wake_starved(self)
+
+    def _notify(self):
+        ResourcePool._notify(self)
+        waiting = len(self._queue) if self._fair else self._waiters
+        if len(self._available) > waiting:
+            # nobody here wants it, a key stuck at the global cap can evict it
+            self._parent._wake_starved(self)
+
+    def _create(self, available=False):
+        self._parent._destroy_evicted()
+        return ResourcePool._create(self, available)
+
+    def _get_executor(self):
+        return self._parent._get_executor()
+
+
+class KeyedResourcePool(object):
+    def __init__(self, factory=None, max_total=None, max_per_key=None,
+                 callback_workers=None, callback_executor=None, **kwargs):
+        """
+        A pool of objects per key, eg. connections per backend host, that all
+        share one lock, one set of callback worker threads and one reaper
+        thread rather than each key having its own.
+
+        'factory', if given, is called with a key and returns a new object for
+        that key. The pool for a key is created the first time the key is
+        used, or objects can be added for a key by hand with add().
+
+        'max_per_key' is the 'max_size' of each key's pool and 'max_total'
+        caps the number of objects across all the keys. When a key needs a
+        new object and the pool is at 'max_total', an idle object of another
+        key (the one with the most idle objects) is destroyed to make room. If
+        there isn't one the caller waits until there is.
+
+        The rest of the arguments are those of ResourcePool (return_callback,
+        min_size, idle_timeout, validate, fair, strategy, ...) and apply to
+        the pool of every key. 'strategy' must be given as a name or a class
+        as each key needs its own instance, and 'callback_queue_size' limits
+        the callbacks waiting per key.
+        """
+        if factory is None and kwargs.get('min_size'):
+            raise ValueError("'min_size' needs a 'factory' to create objects.")
+        if max_per_key is not None and kwargs.get('min_size', 0) > max_per_key:
+            raise ValueError("'min_size' can't be larger than 'max_per_key'.")
+        self._factory = factory
+        self._max_total = max_total
+        self._max_per_key = max_per_key
+        self._kwargs = kwargs
+        self._lock = RLock()
+        self._pools = {}
+        # the key's pool each object is a member of, by id()
+        self._owners = {}
+        # (pool, object) pairs evicted to make room, destroyed outside the lock
+        self._evicted = []
+        # set while evicting, the room made is for the caller evicting
+        self._evicting = False
+        if callback_workers is None:
+            callback_workers = min(32, (os.cpu_count() or 1) + 4)
+        self._callback_workers = callback_workers
+        # created on first use when the pool owns it
+        self._executor = callback_executor
+        self._owns_executor = callback_executor is None
+        self._reaper_stop = Event()
+        self._reaper = None
+        self._closed = False
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._callback_workers,
+                    thread_name_prefix="resource_pool_callback")
+            return self._executor
+
+    def _pool(self, key, create=True):
+        """ Returns the pool for 'key', creating it if needed and allowed. """
+        kwargs = dict(self._kwargs)
+        min_size = kwargs.pop('min_size', 0)
+        if isinstance(kwargs.get('strategy'), type):
+            kwargs['strategy'] = kwargs['strategy']()
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None or not create:
+                return pool
+            if self._closed:
+                raise PoolClosed("The resource pool has been closed.")
+            pool = _KeyedSubPool(
+                self, key, max_size=self._max_per_key,
+                factory=functools.partial(self._factory, key) if self._factory else None,
+                **kwargs)
+            self._pools[key] = pool
+            if pool._reaper_interval is not None and self._reaper is None:
+                self._reaper = Thread(
+                    target=_reaper, name="resource_pool_reaper", daemon=True,
+                    args=(weakref.ref(self), self._reaper_stop, pool._reaper_interval))
+                self._reaper.start()
+            # filled up to 'min_size' below so the factory isn't run with the
+            # lock of every key held
+            pool._min_size = min_size
+        if min_size:
+            pool._reap()
+        return pool
+
+    def pool_for(self, key):
+        """
+        Returns the ResourcePool holding the objects of 'key', for the calls
+        this class doesn't wrap (get_resources(), add_listener(), ...). Raises
+        KeyError if there isn't one and the pool has no factory to create it.
+        """
+        pool = self._pool(key, create=self._factory is not None)
+        if pool is None:
+            raise KeyError(key)
+        return pool
+
+    def keys(self):
+        with self._lock:
+            return list(self._pools)
+
+    def _total(self):
+        return sum(p._active + p._creating for p in self._pools.values())
+
+    def _make_room(self, pool, wanted):
+        """ Returns how many of 'wanted' new objects 'pool' may create without
+        going over 'max_total', evicting idle objects of other keys if that
+        makes room for all of them. Must be called with the lock held.
+        """
+        if self._max_total is None:
+            return wanted
+        room = max(self._max_total - self._total(), 0)
+        if room >= wanted:
+            return wanted
+        victims = [p for p in self._pools.values()
+                   if p is not pool and p._available and p._active > p._min_size and
+                   p._can_retire()]
+        idle = sum(min(len(p._available), p._active - p._min_size) for p in victims)
+        if room + idle < wanted:
+            return room
+        self._evicting = True
+        try:
+            room = self._evict(pool, victims, room, wanted)
+        finally:
+            self._evicting = False
+        return room
+
+    def _evict(self, pool, victims, room, wanted):
+        while room < wanted:
+            victim = max(victims, key=lambda p: len(p._available))
+            obj = victim._available.take()
+            victim._retire(obj)
+            self._evicted.append((victim, obj))
+            room += 1
+            if not victim._available or victim._active <= victim._min_size or \
+                    not victim._can_retire():
+                victims.remove(victim)
+        return wanted
+
+    def _wake_starved(self, freed_by):
+        """ Wakes the waiters of keys that might be waiting for room under
+        'max_total'. Must be called with the lock held.
+        """
+        if self._max_total is None or self._evicting:
+            return
+        for pool in self._pools.values():
+            if pool is not freed_by and pool._waiters and pool._factory is not None:
+                ResourcePool._notify(pool)
+
+    def _destroy_evicted(self):
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+        for pool, obj in evicted:
+            pool._destroy_objects([obj])
+
+    def _reap(self):
+        for pool in list(self._pools.values()):
+            pool._reap()
+        self._destroy_evicted()
+
+    def add(self, key, obj):
+        """
+        Adds objects to the pool of 'key', 'obj' can be a single object or a
+        list of objects. They count towards 'max_total' but are added even if
+        that takes the pool over it.
+        """
+        with self._lock:
+            for o in (obj if type(obj) is list else [obj]):
+                owner = self._owners.get(id(o))
+                if owner is not None and owner.key != key:
+                    raise ObjectAlreadyInPool(
+                        "Object is already in the pool for another key.")
+        self._pool(key).add(obj)
+
+    def _owner(self, obj):
+        with self._lock:
+            pool = self._owners.get(id(obj))
+        if pool is None:
+            raise ObjectNotInPool("Object {} not a member of the pool".format(str(obj)))
+        return pool
+
+    def remove(self, obj):
+        """
+        Removes an object from the pool of the key it belongs to, see
+        ResourcePool.remove(). AllResourcesRemoved is raised when it was the
+        last object of that key.
+        """
+        self._owner(obj).remove(obj)
+
+    def get_resource_unmanaged(self, key, block=True, timeout=None, deadline=None,
+                               priority=0):
+        """
+        Gets a resource for 'key', see ResourcePool.get_resource_unmanaged().
+        It is up to you to return it with return_resource().
+        """
+        return self.pool_for(key).get_resource_unmanaged(
+            block=block, timeout=timeout, deadline=deadline, priority=priority)
+
+    def return_resource(self, obj, force=False):
+        """ Returns a resource to the pool of the key it belongs to. """
+        self._owner(obj).return_resource(obj, force=force)
+
+    @contextmanager
+    def get_resource(self, key, block=True, timeout=None, deadline=None, priority=0,
+                     lease=False):
+        """
+        Intended to be used in a 'with' statement, like
+        ResourcePool.get_resource() but for the objects of 'key'. eg:
+
+            with pool.get_resource('db1.example.com') as conn:
+                do_stuff(conn)
+        """
+        with self.pool_for(key).get_resource(block=block, timeout=timeout,
+                                             deadline=deadline, priority=priority,
+                                             lease=lease) as obj:
+            yield obj
+
+    def stats(self):
+        """
+        Returns the counters of ResourcePool.stats() summed over all the keys,
+        plus 'keys', a dict of the stats() of each key's pool.
+        """
+        with self._lock:
+            per_key = dict((key, pool.stats()) for key, pool in self._pools.items())
+        stats = dict((name, sum(s[name] for s in per_key.values()))
+                     for name in _SUMMED_STATS)
+        stats['keys'] = per_key
+        return stats
+
+    def drain(self, timeout=None):
+        """ Waits for the return callbacks of every key, see ResourcePool.drain(). """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        drained = True
+        for pool in list(self._pools.values()):
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            drained = pool.drain(remaining) and drained
+        return drained
+
+    def close(self, timeout=None):
+        """
+        Closes the pool of every key, see ResourcePool.close(), and then
+        shuts down the callback worker threads if the pool created them.
+        Returns True if every object was retired within 'timeout'.
+        """
+        with self._lock:
+            self._closed = True
+            pools = list(self._pools.values())
+        retired = [(pool, pool._shut()) for pool in pools]
+        for pool, objs in retired:
+            pool._destroy_objects(objs)
+        self._reaper_stop.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        closed = True
+        for pool in pools:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            closed = pool._wait_closed(remaining) and closed
+        with self._lock:
+            executor = self._executor if self._owns_executor else None
+            if executor is not None:
+                self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=closed)
+        return closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
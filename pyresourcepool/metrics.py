@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+""" Metrics collected by the resource pool and the listener interface used to
+hook into its hot paths.
+"""
+
+import math
+
+# bucket boundaries grow by a factor of 2**(1/BUCKETS_PER_DOUBLING) starting
+# at MIN_VALUE seconds, which keeps the error of the percentiles under ~10%
+MIN_VALUE = 1e-6
+BUCKETS_PER_DOUBLING = 8
+NUM_BUCKETS = 40 * BUCKETS_PER_DOUBLING
+
+
+class Histogram(object):
+    """ Fixed size log-scale histogram of durations in seconds.
+
+    Recording a value is O(1) and the memory used doesn't grow with the
+    number of values recorded. It isn't thread safe, the pool only records
+    values with its lock held.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', '_buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = [0] * NUM_BUCKETS
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= MIN_VALUE:
+            index = 0
+        else:
+            index = min(int(math.log2(value / MIN_VALUE) * BUCKETS_PER_DOUBLING) + 1,
+                        NUM_BUCKETS - 1)
+        self._buckets[index] += 1
+
+    def percentile(self, p):
+        """ Approximate value below which 'p' percent of the values fall. """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index, n in enumerate(self._buckets):
+            seen += n
+            if n and seen >= rank:
+                upper = MIN_VALUE * 2 ** (index / BUCKETS_PER_DOUBLING)
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        """ Adds the values recorded by another histogram to this one. """
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr)) if v is not None]
+            setattr(self, attr, pick(values) if values else None)
+        self._buckets = [a + b for a, b in zip(self._buckets, other._buckets)]
+
+    def snapshot(self):
+        """ Summary of the histogram as a dict. """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class PoolListener(object):
+    """ Base class for objects that want to be told about what happens in a
+    resource pool, see ResourcePool.add_listener(). Override the methods you
+    are interested in. They are called without the pool lock held, in the
+    thread that did the operation, so they should be quick. Exceptions
+    raised by a listener are printed and otherwise ignored.
+    """
+
+    def on_acquire(self, pool, obj, wait):
+        """ 'obj' was handed out after waiting 'wait' seconds. """
+
+    def on_return(self, pool, obj, hold):
+        """ 'obj' was returned after being held for 'hold' seconds. """
+
+    def on_remove(self, pool, obj):
+        """ 'obj' was removed from the pool. """
+
+    def on_callback_complete(self, pool, obj, duration, error):
+        """ The return callback for 'obj' took 'duration' seconds. 'error' is
+        the exception it raised or None if it succeeded.
+        """
+
+    def on_leak(self, pool, obj, held):
+        """ 'obj' has been checked out for 'held' seconds, longer than the
+        pool's 'max_hold_time'.
+        """
@@ -3,12 +3,24 @@
 """ Basic python object resource pool.
 """
 
-import copy
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import sys
 import time
 import traceback
-from threading import RLock, Thread
+import warnings
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition, Event, RLock, Thread, current_thread
 from contextlib import contextmanager
 
+from pyresourcepool.metrics import Histogram
+from pyresourcepool.strategies import STRATEGIES
+
 # Callback attribute name when adding a return callback to an object
 CALLBACK_ATTRIBUTE = 'resource_pool_return_callback'
 
@@ -29,11 +41,283 @@ class ObjectNotInPool(Exception):
     """
 
 
+class ResourceTimeout(Exception):
+    """ Raised when a resource could not be obtained from the pool before
+    the timeout or deadline given to get_resource() expired.
+    """
+
+
+class PoolExhausted(Exception):
+    """ Raised instead of waiting for a resource when 'max_waiters' callers
+    are already waiting.
+    """
+
+
+class CircuitOpen(PoolExhausted):
+    """ Raised instead of handing out or waiting for a resource while the
+    pool's circuit breaker is open after too many return callbacks failed.
+    """
+
+
+class PoolClosed(Exception):
+    """ Raised when trying to get a resource from, or add one to, a pool
+    that has been closed, including callers that were waiting when it was.
+    """
+
+
+class ResourceLeakWarning(UserWarning):
+    """ Warned about when a resource has been checked out for longer than
+    'max_hold_time' or a Lease was garbage collected without being released.
+    """
+
+
+class _Resource(object):
+    """ The pool's record of one of its objects, holding everything the pool
+    keeps about it.
+    """
+    __slots__ = ('obj', 'removed', 'created_at', 'last_returned_at', 'use_count',
+                 'checked_out_at', 'validated_at', 'holder', 'stack', 'leak_reported',
+                 'retiring', 'destroy')
+
+    def __init__(self, obj, now):
+        self.obj = obj
+        # set when the object is removed while it is checked out, the record
+        # is dropped when it comes back
+        self.removed = False
+        self.created_at = now
+        self.last_returned_at = now
+        self.use_count = 0
+        self.validated_at = now
+        # only kept up to date when the pool collects metrics or tracks
+        # checkouts
+        self.checked_out_at = None
+        # name of the thread that checked the object out and where, when the
+        # pool tracks checkouts
+        self.holder = None
+        self.stack = None
+        self.leak_reported = False
+        # set by shrink() on a checked out object, retired when it comes back
+        # and destroyed with 'destroy' if it isn't None
+        self.retiring = False
+        self.destroy = None
+
+
+class Lease(object):
+    """ A resource borrowed from a pool with ResourcePool.lease() or
+    get_resource(lease=True), along with the options of this one checkout:
+      - on_return(callback): the return callback to run this time, instead
+        of the pool's.
+      - discard(): the resource is broken, it is removed from the pool (and
+        destroyed, and replaced if the pool has a 'replace' function) rather
+        than returned.
+      - metadata: a dict for the caller to keep anything about the checkout.
+    None of this touches the resource itself, so it works for any object
+    and returning it doesn't look for a 'resource_pool_return_callback'
+    attribute on it.
+
+    The resource goes back to the pool when release() is called, at the end
+    of a 'with' block on the lease or, for a lease from lease() that wasn't
+    released, when the lease is garbage collected. A ResourceLeakWarning is
+    warned about then and the resource is returned as if with no options.
+    """
+    __slots__ = ('resource', 'metadata', '_pool', '_callback', '_discard',
+                 '_finalizer', '__weakref__')
+
+    def __init__(self, pool, resource, reclaim=True):
+        self.resource = resource
+        self.metadata = {}
+        self._pool = pool
+        self._callback = None
+        self._discard = False
+        self._finalizer = None
+        if reclaim:
+            self._finalizer = weakref.finalize(self, _reclaim_leased,
+                                               weakref.ref(pool), resource)
+            self._finalizer.atexit = False
+            # the finalizer mustn't be the only thing keeping the pool alive
+            self._pool = None
+
+    def on_return(self, callback):
+        """ Sets the return callback to run on the resource when it is
+        returned, instead of the pool's 'return_callback'.
+        """
+        self._callback = callback
+
+    def discard(self):
+        """ Marks the resource as broken, it is taken out of the pool when the
+        lease is released.
+        """
+        self._discard = True
+
+    def release(self):
+        """ Returns the resource to the pool, only the first call does. """
+        if self._finalizer is None:
+            pool, self._pool = self._pool, None
+        else:
+            released = self._finalizer.detach()
+            # (lease, func, args, kwargs), args being (pool_ref, resource)
+            pool = released[2][0]() if released is not None else None
+        if pool is not None:
+            pool._return_leased(self.resource, self._callback, self._discard)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _reclaim_leased(pool_ref, resource):
+    """ Finalizer of a Lease that was never released. """
+    pool = pool_ref()
+    if pool is None:
+        return
+    warnings.warn(ResourceLeakWarning(
+        "Resource {} was never returned to the pool, its Lease was garbage "
+        "collected.".format(resource)))
+    pool._leaked.append(resource)
+    if not pool._lock._is_owned():
+        pool._reclaim_leaked()
+
+
+class _Waiter(object):
+    """ A caller queued in a fair pool waiting for 'n' objects. """
+    __slots__ = ('n', 'key', 'affinity', 'cond', 'taken')
+
+    def __init__(self, n, priority, arrival, affinity, cond):
+        self.n = n
+        self.affinity = affinity
+        # higher priorities first, then in order of arrival
+        self.key = (-priority, arrival)
+        self.cond = cond
+        # set to what _try_take() returned once objects are handed over
+        self.taken = None
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+# returned internally when there is no resource to hand out, unlike None it
+# can't be mistaken for an object in the pool
+_NO_RESOURCE = object()
+
+# autoscaling grows the pool when at least this share of its objects are in
+# use or callers had to wait, and shrinks it when fewer than this are
+_SCALE_UP_UTILIZATION = 0.8
+_SCALE_DOWN_UTILIZATION = 0.3
+
+
+def _expiry(timeout, deadline):
+    """ The time.monotonic() time a wait expires given a relative 'timeout'
+    and/or absolute 'deadline', whichever comes first. None if neither.
+    """
+    if timeout is None:
+        return deadline
+    expires = time.monotonic() + timeout
+    if deadline is not None:
+        expires = min(expires, deadline)
+    return expires
+
+
+# frames in these files are left out of the stacks captured by the pool
+_INTERNAL_FILES = (__file__, contextlib.__file__)
+
+
+def _acquiring_stack(limit=20):
+    """ Where the current thread is, without the frames of the pool itself
+    or of contextlib. Source lines aren't looked up here so this stays cheap.
+    """
+    frames = [(f, lineno) for f, lineno in traceback.walk_stack(sys._getframe(1))
+              if f.f_code.co_filename not in _INTERNAL_FILES]
+    return traceback.StackSummary.extract(reversed(frames[:limit]), lookup_lines=False)
+
+
+def _reaper(pool_ref, stop, interval):
+    """ Body of the reaper thread. Only a weak reference to the pool is held
+    so the thread doesn't keep an otherwise unused pool alive.
+    """
+    while not stop.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
+        try:
+            pool._reap()
+        except Exception:
+            traceback.print_exc()
+        del pool
+
+
 class ResourcePool(object):
-    def __init__(self, objects, return_callback=None):
+    # False for pools whose _reap() is run by someone else's reaper thread
+    _own_reaper = True
+
+    def __init__(self, objects=(), return_callback=None, callback_workers=None,
+                 callback_queue_size=None, callback_executor=None, factory=None,
+                 min_size=0, max_size=None, idle_timeout=None, max_lifetime=None,
+                 max_uses=None, destroy=None, reaper_interval=None, metrics=False,
+                 validate=None, validate_on_borrow=True, validate_idle_time=None,
+                 validate_on_return=False, validate_interval=None, replace=None,
+                 fair=False, strategy='fifo', track_checkouts=False,
+                 capture_stack=False, max_hold_time=None, warmup=None,
+                 max_waiters=None, breaker_failure_rate=None, breaker_window=20,
+                 breaker_cooldown=30.0, autoscale_interval=None):
         """
         Instantiate with a list of objects you want in the resource pool.
 
+        Alternatively (or as well) a 'factory' can be given, a function that
+        takes no arguments and returns a new object for the pool. Only enough
+        objects to make up 'min_size' are created up front, after that a new
+        object is created whenever a resource is requested, none are
+        available and the pool holds fewer than 'max_size' objects (no limit
+        if 'max_size' is None). Objects are created without holding the pool
+        lock so a slow factory doesn't hold up other users of the pool, and
+        objects added with add() count towards 'max_size'. A pool with a
+        factory never raises AllResourcesRemoved as it can always create
+        more objects.
+
+        Objects can be retired from the pool automatically:
+          - 'idle_timeout': objects that have sat unused in the pool for
+            this many seconds are removed, as long as the pool holds more
+            than 'min_size' objects.
+          - 'max_lifetime': objects older than this many seconds are
+            removed when they are next returned or found idle.
+          - 'max_uses': objects that have been handed out this many times
+            are removed when they are returned.
+        Checked out objects are never evicted. A pool without a factory
+        always keeps at least one object, a pool with a factory is topped
+        back up to 'min_size'. 'destroy', if given, is called with each
+        object the pool retires. A single background "reaper" thread checks
+        the idle objects every 'reaper_interval' seconds (by default half the
+        shortest of the limits, at most 60s).
+
+        Counts of what the pool has done are always available from stats().
+        If 'metrics' is True the pool also keeps histograms of how long
+        callers wait for a resource, how long they hold it and how long
+        return callbacks take, which costs a few clock reads per operation.
+
+        'validate' is an optional health check, a function that takes an
+        object and returns True if it is fit for use. Returning False or
+        raising an exception means the object is removed from the pool. It
+        is run:
+          - when an object is handed out, if 'validate_on_borrow' is True
+            (the default). If 'validate_idle_time' is given, only for objects
+            that haven't been used or checked for that many seconds, which
+            keeps the check off the hot path for busy objects. A caller is
+            never handed an object that failed, the next one is tried.
+          - when an object is returned, if 'validate_on_return' is True. This
+            is done by a callback worker after any return callback.
+          - every 'validate_interval' seconds on the idle objects, by the
+            reaper thread.
+        'replace', if given, is called with each object that failed a check
+        and returns a new object to add to the pool in its place.
+
+        If 'track_checkouts' is True the pool remembers which thread checked
+        out each object and when, see checked_out(), and with 'capture_stack'
+        also where from. With 'max_hold_time' (seconds) the reaper thread
+        warns with a ResourceLeakWarning about objects checked out for longer
+        than that, and tells the listeners' on_leak(). Either turns on
+        'track_checkouts'.
+
         'return_callback' is a function or method that can be used to
         perform some action on an object before it is returned to the
         pool but without making the process that returned the object
@@ -47,22 +331,537 @@ class ResourcePool(object):
         argument and success is measured by no exceptions being raised. If
         an exception is raised by the callback then the object will be removed
         from the pool rather than being returned as an available resource.
+
+        Return callbacks are run by a pool of worker threads owned by the
+        resource pool rather than a new thread per returned object.
+        'callback_workers' sets the number of worker threads (the default
+        is the same as concurrent.futures.ThreadPoolExecutor's). If
+        'callback_queue_size' is given, at most that many callbacks can be
+        waiting for a free worker and return_resource() blocks until there
+        is room, which stops slow callbacks from piling up without limit.
+        'callback_executor' is an optional concurrent.futures.Executor to
+        run the callbacks in instead, it is not shut down by close().
+
+        'warmup' is an optional function taking an object that gets it ready
+        for use (connect, log in, reset, ...). It is run on each of 'objects'
+        by the callback workers, in parallel and in the background, and each
+        object becomes available as soon as its warm-up finished, so the pool
+        can be used straight away. A warm-up that raises an exception is
+        treated like a failed return callback, the object is removed from the
+        pool. wait_ready() waits for the warm-ups.
+
+        To shed load rather than letting every thread pile up waiting for a
+        resource, 'max_waiters' limits how many callers can wait at once, a
+        caller that would have to wait beyond that gets PoolExhausted
+        straight away. 'breaker_failure_rate' (0 to 1) turns on a circuit
+        breaker: when at least that share of the last 'breaker_window' return
+        callbacks (and warm-ups) failed the circuit opens and for
+        'breaker_cooldown' seconds every acquisition, including those already
+        waiting, fails with CircuitOpen. After that the pool is used again
+        and the next callback to finish decides whether the circuit closes
+        (it succeeded) or opens again (it failed).
+
+        A pool can be grown or shrunk at any time with resize() and shrink().
+        With 'autoscale_interval' (seconds, needs a 'factory') the reaper
+        thread also does it by itself, between 'min_size' and 'max_size':
+        when callers had to wait or most objects are in use it adds a quarter
+        more objects ahead of demand, when few are in use it retires an idle
+        one.
         """
-        # used to track the original pool of resources, not used yet
-        self._objects = objects
-        self._removed = {}
-        for o in self._objects:
-            self._removed[id(o)] = False
-
-        # create another list with the same object references:
-        # copy.copy() only copies the references so the two lists are
-        # separate lists that point to the same objects
-        self._available = copy.copy(objects)
-        self._lock = RLock()
+        # the _Resource record of every object in the pool keyed by id(). An
+        # object's record is dropped as soon as the object has left the pool
+        # and isn't checked out, holding the reference until then keeps the
+        # id() of each object unique
+        self._records = {}
+        # number of objects in the pool that have not been removed
+        self._active = 0
+        if isinstance(strategy, str):
+            strategy = STRATEGIES[strategy]()
+        self._available = strategy
+        self._lock = self._make_lock()
+        # waiters in get_resource_unmanaged() block on this condition, it
+        # shares self._lock so it is always notified with the lock held
+        self._cond = Condition(self._lock)
         self._return_callback = return_callback
+        # number of acquisitions that gave up because of a timeout/deadline
+        self._timeouts = 0
+        # number of get_resources() calls waiting for several objects at once
+        self._batch_waiters = 0
+        # number of callers waiting in total
+        self._waiters = 0
+        self._fair = fair
+        # heap of the _Waiters of a fair pool and a counter to order them
+        self._queue = []
+        self._arrivals = itertools.count()
+        self._acquires = 0
+        self._removed_count = 0
+        self._callback_failures = 0
+        self._max_waiters = max_waiters
+        # number of times a caller had to wait, for autoscaling
+        self._waits = 0
+        # acquisitions turned away by 'max_waiters' or the circuit breaker
+        self._rejected = 0
+        if breaker_failure_rate is not None and not 0 < breaker_failure_rate <= 1:
+            raise ValueError("'breaker_failure_rate' must be more than 0 and at most 1.")
+        self._breaker_failure_rate = breaker_failure_rate
+        self._breaker_cooldown = breaker_cooldown
+        # True/False for each of the last 'breaker_window' callbacks that
+        # failed/succeeded, when the circuit opens and whether it is waiting
+        # for the callback that decides if it closes
+        self._breaker_results = deque(maxlen=breaker_window)
+        self._open_until = None
+        self._half_open = False
+        # number of objects whose return callback hasn't finished
+        self._in_callback = 0
+        self._metrics = metrics
+        self._listeners = []
+        self._capture_stack = capture_stack
+        self._max_hold_time = max_hold_time
+        self._track = track_checkouts or capture_stack or max_hold_time is not None
+        # resources of Leases that were garbage collected, returned to the
+        # pool by _reclaim_leaked()
+        self._leaked = []
+        # timing is only done when something will use it
+        self._instrumented = metrics or self._track
+        self._wait_times = Histogram()
+        self._hold_times = Histogram()
+        self._callback_times = Histogram()
+
+        if callback_workers is None:
+            callback_workers = min(32, (os.cpu_count() or 1) + 4)
+        self._callback_workers = callback_workers
+        # created on first use when the pool owns it
+        self._executor = callback_executor
+        self._owns_executor = callback_executor is None
+        self._callback_slots = None
+        if callback_queue_size is not None:
+            self._callback_slots = BoundedSemaphore(
+                callback_workers + callback_queue_size)
+        # callbacks submitted that haven't finished yet, drain() waits on
+        # self._callbacks_done until this is zero. Once the pool is closed
+        # it is also notified as objects leave the pool, for close()
+        self._callbacks_in_flight = 0
+        self._callbacks_done = Condition(self._lock)
+        self._closed = False
+        # warm-ups not finished yet and objects that were warmed up, waited
+        # for by wait_ready() on self._ready
+        self._warmup = warmup
+        self._warming = 0
+        self._warmed = 0
+        self._warm_total = 0
+        self._ready = Condition(self._lock)
+        if factory is None and min_size:
+            raise ValueError("'min_size' needs a 'factory' to create objects.")
+        if max_size is not None and min_size > max_size:
+            raise ValueError("'min_size' can't be larger than 'max_size'.")
+        self._factory = factory
+        self._min_size = min_size
+        self._max_size = max_size
+        # number of objects being created by the factory right now
+        self._creating = 0
+        # checked out objects marked by shrink(), retired when returned
+        self._retiring = 0
+        # functions given to shrink() to destroy objects retired by
+        # _retire() with, popped by _destroy_objects()
+        self._destroy_with = {}
+        if autoscale_interval is not None and factory is None:
+            raise ValueError("'autoscale_interval' needs a 'factory' to create objects.")
+        self._autoscale_interval = autoscale_interval
+        self._waits_seen = 0
+        self._scaled_at = time.monotonic()
+
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self._max_uses = max_uses
+        self._destroy = destroy
+        self._validate = validate
+        self._validate_on_borrow = validate is not None and validate_on_borrow
+        self._validate_idle_time = validate_idle_time
+        self._validate_on_return = validate is not None and validate_on_return
+        self._validate_interval = validate_interval if validate is not None else None
+        self._replace = replace
+        self._reaper_stop = Event()
+        self._reaper = None
+        limits = [t for t in (idle_timeout, max_lifetime, self._validate_interval,
+                              max_hold_time, autoscale_interval)
+                  if t is not None]
+        if limits and reaper_interval is None:
+            reaper_interval = min(min(limits) / 2.0, 60)
+        self._reaper_interval = reaper_interval
+        if reaper_interval is not None and self._own_reaper:
+            self._reaper = Thread(
+                target=_reaper, name="resource_pool_reaper", daemon=True,
+                args=(weakref.ref(self), self._reaper_stop, reaper_interval))
+
+        # the same object listed more than once is only added once, the
+        # pool doesn't keep a reference to the caller's list
+        objects = list(OrderedDict((id(o), o) for o in objects).values())
+        self._warm_total = len(objects)
+        if warmup is None:
+            self.add(objects)
+            self._warmed = len(objects)
+        else:
+            self._start_warmups(objects)
+        if self._active < min_size:
+            self.add([factory() for i in range(min_size - self._active)])
+        if self._reaper is not None:
+            self._reaper.start()
+
+    def _make_lock(self):
+        return RLock()
 
     def all_removed(self):
-        return all(self._removed[id(o)] for o in self._objects)
+        """ True if the pool has no objects left and can't create more. """
+        return self._active == 0 and self._creating == 0 and not self._can_grow()
+
+    def _notify(self):
+        """ Wakes a waiter after an object became available, or every waiter
+        when some are after more than one object as the one woken might not
+        be able to use it. Must be called with the lock held.
+        """
+        if self._fair:
+            self._handoff()
+        elif self._batch_waiters:
+            self._cond.notify_all()
+        else:
+            self._cond.notify()
+
+    def _wake_all(self):
+        """ Wakes every waiter, eg. so they can see the pool is empty. Must be
+        called with the lock held.
+        """
+        self._cond.notify_all()
+        for waiter in self._queue:
+            waiter.cond.notify()
+
+    def _can_grow(self):
+        return self._factory is not None and (
+            self._max_size is None or
+            self._active + self._creating < self._max_size)
+
+    def _growth_room(self, wanted):
+        """ How many of 'wanted' new objects the factory may create right
+        now. Must be called with the lock held.
+        """
+        if self._factory is None:
+            return 0
+        if self._max_size is not None:
+            wanted = min(wanted, self._max_size - self._active - self._creating)
+        return max(wanted, 0)
+
+    def _capacity_freed(self):
+        """ Called with the lock held whenever an object leaves the pool or a
+        reserved slot for a new one is given up.
+        """
+
+    def _register(self, o):
+        """ Makes 'o' a member of the pool, must be called with the lock held. """
+        if o is None:
+            raise ValueError("None can't be a resource, it means 'no resource'.")
+        if id(o) in self._records:
+            raise ObjectAlreadyInPool("Object is already in the pool.")
+        self._records[id(o)] = _Resource(o, time.monotonic())
+        self._active += 1
+
+    def _drop(self, rec):
+        """ Forgets an object that has left the pool for good. Must be called
+        with the lock held.
+        """
+        rec.removed = True
+        if rec.retiring:
+            rec.retiring = False
+            self._retiring -= 1
+        del self._records[id(rec.obj)]
+        self._available.forget(rec.obj)
+
+    def _expired(self, meta, now):
+        """ True if an object has reached 'max_lifetime' or 'max_uses'. """
+        return (self._max_lifetime is not None and
+                now - meta.created_at >= self._max_lifetime) or \
+            (self._max_uses is not None and meta.use_count >= self._max_uses)
+
+    def _can_retire(self):
+        """ True if the pool can lose an object without becoming unusable. """
+        return self._factory is not None or self._active > 1
+
+    def _retire(self, obj):
+        """ Removes an object the pool decided to get rid of, like remove() but
+        never raises. The object must be available or in the caller's hands,
+        it is dropped from the pool straight away. Must be called with the lock held, the caller must call
+        self._destroy_objects() once the lock is released.
+        """
+        self._active -= 1
+        self._removed_count += 1
+        self._available.discard(obj)
+        rec = self._records[id(obj)]
+        if rec.destroy is not None:
+            self._destroy_with[id(obj)] = rec.destroy
+        self._drop(rec)
+        self._capacity_freed()
+        if self._closed:
+            self._callbacks_done.notify_all()
+        if self.all_removed():
+            # wake everyone waiting so they can raise AllResourcesRemoved
+            self._wake_all()
+        elif self._can_grow():
+            self._notify()
+
+    def _destroy_objects(self, objs):
+        if self._listeners:
+            for o in objs:
+                self._call_listeners('on_remove', o)
+        if self._destroy is None and not self._destroy_with:
+            return
+        for o in objs:
+            destroy = self._destroy_with.pop(id(o), self._destroy)
+            if destroy is None:
+                continue
+            try:
+                destroy(o)
+            except Exception:
+                traceback.print_exc()
+
+    def _reap(self):
+        """ Retires idle and expired objects and tops the pool back up to
+        'min_size'. Run periodically by the reaper thread.
+        """
+        now = time.monotonic()
+        retired = []
+        with self._lock:
+            for obj in list(self._available):
+                meta = self._records[id(obj)]
+                idle = self._idle_timeout is not None and \
+                    now - meta.last_returned_at >= self._idle_timeout and \
+                    self._active > self._min_size
+                if (idle or self._expired(meta, now)) and self._can_retire():
+                    self._retire(obj)
+                    retired.append(obj)
+            refill = 0
+            if self._factory is not None:
+                refill = max(self._min_size - self._active - self._creating, 0)
+                self._creating += refill
+            if self._autoscale_interval is not None and \
+                    now - self._scaled_at >= self._autoscale_interval:
+                refill += self._autoscale(now, retired)
+        self._destroy_objects(retired)
+        for i in range(refill):
+            try:
+                self._create(available=True)
+            except Exception:
+                traceback.print_exc()
+        if self._validate_interval is not None:
+            self._validate_idle(now)
+        if self._max_hold_time is not None:
+            self._report_leaks(now)
+        if self._leaked:
+            self._reclaim_leaked()
+
+    def _autoscale(self, now, retired):
+        """ Decides whether the pool should grow or shrink since the last
+        time. Retires an idle object by adding it to 'retired', or returns how
+        many objects the caller must create (their slots are reserved). Must
+        be called with the lock held.
+        """
+        self._scaled_at = now
+        waited = self._waits != self._waits_seen
+        self._waits_seen = self._waits
+        size = self._active + self._creating - self._retiring
+        in_use = size - len(self._available)
+        if waited or in_use >= _SCALE_UP_UTILIZATION * size:
+            grow = self._growth_room(max(size // 4, 1))
+            self._creating += grow
+            return grow
+        if in_use < _SCALE_DOWN_UTILIZATION * size and size > self._min_size and \
+                self._available:
+            obj = self._available.take()
+            self._retire(obj)
+            retired.append(obj)
+        return 0
+
+    def size(self):
+        """ The number of objects in the pool, not counting those that are
+        being retired by shrink() or resize() once they are returned.
+        """
+        with self._lock:
+            return self._active + self._creating - self._retiring
+
+    def resize(self, target, destroy=None):
+        """
+        Grows or shrinks the pool to 'target' objects. Growing needs a
+        'factory', the new objects are created straight away. Shrinking is
+        done by shrink(), 'destroy' is passed on to it. For a pool with a
+        factory 'target' also becomes its 'max_size' (and 'min_size' if that
+        was larger), so it doesn't grow back on demand.
+
+        Returns the number of objects added, or removed as a negative number.
+        """
+        if target < 0:
+            raise ValueError("'target' can't be negative.")
+        with self._lock:
+            if self._factory is None and target > self._active - self._retiring:
+                raise ValueError("Growing the pool needs a 'factory', use add().")
+            if self._factory is not None:
+                self._max_size = target
+                self._min_size = min(self._min_size, target)
+            change = target - (self._active + self._creating - self._retiring)
+            grow = self._growth_room(change) if change > 0 else 0
+            self._creating += grow
+        if change < 0:
+            return -self.shrink(-change, destroy=destroy)
+        for i in range(grow):
+            try:
+                self._create(available=True)
+            except BaseException:
+                with self._lock:
+                    # release the slots of the objects not created yet
+                    self._creating -= grow - i - 1
+                    self._capacity_freed()
+                raise
+        return grow
+
+    def shrink(self, n, destroy=None):
+        """
+        Takes 'n' objects out of the pool without disrupting anyone: idle ones
+        are retired straight away and, if there aren't enough of those,
+        checked out objects are retired as they are returned. Unlike remove()
+        this never raises AllResourcesRemoved, a pool without a factory keeps
+        at least one object so 'n' is cut down to leave that.
+
+        The retired objects are destroyed with 'destroy' if it is given,
+        otherwise with the pool's 'destroy'. Returns the number of objects
+        that were or will be retired.
+        """
+        if n < 0:
+            raise ValueError("'n' can't be negative.")
+        retired = []
+        with self._lock:
+            keep = 0 if self._factory is not None else 1
+            n = max(min(n, self._active - self._retiring - keep), 0)
+            while len(retired) < n and self._available:
+                obj = self._available.take()
+                self._records[id(obj)].destroy = destroy
+                self._retire(obj)
+                retired.append(obj)
+            marked = 0
+            if len(retired) < n:
+                for rec in list(self._records.values()):
+                    if len(retired) + marked == n:
+                        break
+                    if rec.removed or rec.retiring or rec.obj in self._available:
+                        continue
+                    rec.retiring = True
+                    rec.destroy = destroy
+                    self._retiring += 1
+                    marked += 1
+        self._destroy_objects(retired)
+        return len(retired) + marked
+
+    def _report_leaks(self, now):
+        """ Warns about the objects checked out for over 'max_hold_time'
+        seconds, once per checkout.
+        """
+        leaks = []
+        with self._lock:
+            for rec in self._records.values():
+                if rec.checked_out_at is not None and not rec.leak_reported and \
+                        now - rec.checked_out_at >= self._max_hold_time:
+                    rec.leak_reported = True
+                    leaks.append((rec.obj, now - rec.checked_out_at, rec.holder,
+                                  rec.stack))
+        for obj, held, holder, stack in leaks:
+            message = "Resource {} has been held by thread {} for {:.1f}s.".format(
+                obj, holder, held)
+            if stack is not None:
+                message += " It was checked out at:\n" + "".join(stack.format())
+            warnings.warn(ResourceLeakWarning(message))
+            if self._listeners:
+                self._call_listeners('on_leak', obj, held)
+
+    def _reclaim_leaked(self):
+        """ Returns the resources of garbage collected Leases to the pool. """
+        while self._leaked:
+            try:
+                obj = self._leaked.pop()
+            except IndexError:
+                return
+            try:
+                self.return_resource(obj)
+            except Exception:
+                traceback.print_exc()
+
+    def _validate_idle(self, now):
+        """ Checks the idle objects that haven't been checked for
+        'validate_interval' seconds. They are taken out of the pool while
+        they're checked so they can't be handed out half way through.
+        """
+        with self._lock:
+            due = [obj for obj in self._available
+                   if now - self._records[id(obj)].validated_at >= self._validate_interval]
+            for obj in due:
+                self._available.discard(obj)
+            self._in_callback += len(due)
+        for obj in due:
+            healthy = self._check(obj)
+            with self._lock:
+                self._in_callback -= 1
+                rec = self._records[id(obj)]
+                if rec.removed:
+                    # removed while it was being checked
+                    self._drop(rec)
+                elif healthy and self._closed:
+                    self._retire(obj)
+                    healthy = None
+                elif healthy:
+                    self._available.append(obj)
+                    self._notify()
+            if healthy is None:
+                self._destroy_objects([obj])
+            elif not healthy:
+                self._discard_unhealthy(obj)
+
+    def _check(self, obj):
+        """ Runs the 'validate' health check, True if 'obj' is healthy. """
+        try:
+            healthy = bool(self._validate(obj))
+        except Exception:
+            traceback.print_exc()
+            healthy = False
+        if healthy:
+            self._records[id(obj)].validated_at = time.monotonic()
+        return healthy
+
+    def _needs_borrow_check(self, obj):
+        if not self._validate_on_borrow:
+            return False
+        if self._validate_idle_time is None:
+            return True
+        meta = self._records[id(obj)]
+        return time.monotonic() - max(meta.last_returned_at, meta.validated_at) \
+            >= self._validate_idle_time
+
+    def _discard_unhealthy(self, obj):
+        """ Removes an object that failed its health check, without raising,
+        and adds the object made by 'replace' in its place. The object is in
+        the caller's hands and won't be returned.
+        """
+        with self._lock:
+            rec = self._records.get(id(obj))
+            if rec is None:
+                return
+            if rec.removed:
+                # removed while it was being checked
+                self._drop(rec)
+                return
+            self._retire(obj)
+        self._destroy_objects([obj])
+        if self._replace is None or self._closed:
+            return
+        try:
+            new = self._replace(obj)
+        except Exception:
+            traceback.print_exc()
+            return
+        self.add(new)
 
     def add(self, obj):
         """
@@ -72,32 +871,61 @@ class ResourcePool(object):
         if type(obj) is not list:
             obj = [obj]
         with self._lock:
+            self._check_open()
             for o in obj:
-                if o in self._objects:
-                    raise ObjectAlreadyInPool("Object is already in the pool.")
-                self._objects.append(o)
+                self._register(o)
                 self._available.append(o)
-                self._removed[id(o)] = False
+                self._notify()
 
     def remove(self, obj):
         """
         Removes an object from the pool so that it can't be handed out as an
         available resource again. If the object passed in is not in the pool
         an ObjectNotInPool exception is raised.
+
+        The pool forgets about an object as soon as it is removed, or if it is
+        checked out when it is returned, so the pool doesn't hold on to it.
+        """
+        self._remove(obj, gone=False)
+
+    def _remove(self, obj, gone):
+        """ remove(), 'gone' being True if the caller has the object and
+        won't return it so it can be dropped straight away.
         """
         with self._lock:
-            if obj not in self._objects:
+            rec = self._records.get(id(obj))
+            if rec is None:
                 raise ObjectNotInPool("Object is not in the list of pool objects.")
-            # mark the resource as deleted
-            self._removed[id(obj)] = True
-            # if it is currently in the available set, remove it
-            self._available = [o for o in self._available if o is not obj]
-            if self.all_removed():
-                raise AllResourcesRemoved(
-                    "All resources have been removed. "
-                    "Further use of the resource pool is void.")
+            removed = not rec.removed
+            if removed:
+                rec.removed = True
+                self._active -= 1
+                self._removed_count += 1
+                self._capacity_freed()
+                if self._closed:
+                    self._callbacks_done.notify_all()
+            if gone or obj in self._available:
+                self._available.discard(obj)
+                self._drop(rec)
+            else:
+                # checked out or in a callback, dropped when it comes back
+                self._available.forget(obj)
+            all_removed = self.all_removed()
+            if all_removed:
+                # wake everyone waiting so they can raise too
+                self._wake_all()
+            elif self._can_grow():
+                # a waiter can create a replacement
+                self._notify()
+        if removed and self._listeners:
+            self._call_listeners('on_remove', obj)
+        if all_removed:
+            raise AllResourcesRemoved(
+                "All resources have been removed. "
+                "Further use of the resource pool is void.")
 
-    def get_resource_unmanaged(self, block=True):
+    def get_resource_unmanaged(self, block=True, timeout=None, deadline=None,
+                               priority=0, key=None):
         """
         Gets a resource from the pool but in an "unmanaged" fashion. It is
         up to you to return the resource to the pool by calling
@@ -105,6 +933,18 @@ class ResourcePool(object):
 
         Return value is an object from the pool but see the note below.
 
+        If 'block' is True the call waits for a resource to become available.
+        'timeout' (seconds) and/or 'deadline' (an absolute time.monotonic()
+        value) limit that wait, if both are given whichever expires first
+        applies. A ResourceTimeout exception is raised if no resource became
+        available in time. If 'block' is False, None is returned straight
+        away when the pool is depleted.
+
+        In a fair pool waiting callers are served in order of 'priority'
+        (higher first) and then of arrival, in other pools 'priority' is
+        ignored. 'key' is used by the 'affinity' strategy to prefer an object
+        last handed out for the same key.
+
         NOTE:
         You should consider using get_resource() instead in a 'with' statement
         as this will handle returning the resource automatically. eg:
@@ -115,23 +955,446 @@ class ResourcePool(object):
         The resource will be automatically returned upon exiting the 'with'
         block.
         """
-        # if the pool is empty, wait for an object to be returned to the
-        # pool
-        obj = None
+        obj = self._get(block, timeout, deadline, priority, key)
+        return None if obj is _NO_RESOURCE else obj
+
+    def _get(self, block, timeout, deadline, priority, key):
+        """ get_resource_unmanaged() but returns _NO_RESOURCE rather than None
+        when there is nothing available.
+        """
+        expires = _expiry(timeout, deadline)
+        if self._leaked:
+            self._reclaim_leaked()
+        if not self._instrumented:
+            return self._get_one(block, expires, priority, key)
+        start = time.monotonic()
+        obj = self._get_one(block, expires, priority, key)
+        if obj is not _NO_RESOURCE:
+            self._record_acquire([obj], start)
+        return obj
+
+    def _get_one(self, block, expires, priority, key):
         while True:
-            with self._lock:
+            taken = self._take(1, block, expires, priority, key)
+            if taken is None:
+                return _NO_RESOURCE
+            objs, grow = taken
+            if grow:
+                return self._create()
+            obj = objs[0]
+            if not self._needs_borrow_check(obj) or self._check(obj):
+                return obj
+            self._discard_unhealthy(obj)
+
+    def _try_take(self, n, key):
+        """ Takes 'n' objects from the pool if it can, creating the ones that
+        aren't available if the pool is allowed to grow. Returns a tuple of
+        the objects taken and the number of objects the caller must create
+        with self._create() (the slots for them are reserved), or None.
+        Must be called with the lock held.
+        """
+        grow = 0
+        if len(self._available) < n:
+            grow = self._growth_room(n - len(self._available))
+        if len(self._available) + grow < n:
+            return None
+        objs = []
+        for i in range(n - grow):
+            obj = self._available.take(key)
+            self._records[id(obj)].use_count += 1
+            objs.append(obj)
+        self._acquires += n - grow
+        self._creating += grow
+        return objs, grow
+
+    def _take(self, n, block, expires, priority, key):
+        """ Takes 'n' objects from the pool, waiting for them if 'block' is
+        True. Returns what _try_take() does or None if 'block' is False and
+        they weren't available.
+        """
+        if self._fair:
+            return self._take_fair(n, block, expires, priority, key)
+        # if the pool is empty, create a new object if the pool is allowed to
+        # grow, otherwise wait for an object to be returned to the pool
+        with self._lock:
+            waited = False
+            while True:
+                self._check_open()
                 if self.all_removed():
                     raise AllResourcesRemoved(
                         "All resources have been removed. Further use of "
                         "the resource pool is void unless new resources are"
                         "added.")
-                if self._available:
-                    obj = self._available.pop(0)
+                self._check_circuit()
+                taken = self._try_take(n, key)
+                if taken is not None:
+                    return taken
+                if not block:
+                    return None
+                if not waited:
+                    # only a caller that isn't waiting yet can be turned away
+                    self._check_waiters()
+                    waited = True
+                if n == 1:
+                    self._wait(expires)
+                    continue
+                self._batch_waiters += 1
+                try:
+                    self._wait(expires)
+                finally:
+                    self._batch_waiters -= 1
+
+    def _take_fair(self, n, block, expires, priority, key):
+        """ _take() for a fair pool. Callers that have to wait join a queue,
+        ordered by priority and then by arrival, and objects are handed to the
+        caller at the head of the queue as soon as there are enough for it.
+        Nobody can take objects from the pool while someone is queued.
+        """
+        with self._lock:
+            self._check_open()
+            if self.all_removed():
+                raise AllResourcesRemoved(
+                    "All resources have been removed. Further use of "
+                    "the resource pool is void unless new resources are"
+                    "added.")
+            self._check_circuit()
+            if not self._queue:
+                taken = self._try_take(n, key)
+                if taken is not None:
+                    return taken
+            if not block:
+                return None
+            self._check_waiters()
+
+            waiter = _Waiter(n, priority, next(self._arrivals), key,
+                             Condition(self._lock))
+            heapq.heappush(self._queue, waiter)
+            self._waiters += 1
+            self._waits += 1
+            try:
+                self._handoff()
+                while waiter.taken is None:
+                    self._check_open()
+                    if self.all_removed():
+                        raise AllResourcesRemoved(
+                            "All resources have been removed. Further use of "
+                            "the resource pool is void unless new resources are"
+                            "added.")
+                    self._check_circuit()
+                    if expires is None:
+                        waiter.cond.wait()
+                        continue
+                    remaining = expires - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise ResourceTimeout(
+                            "Timed out waiting for a resource from the pool.")
+                    waiter.cond.wait(remaining)
+                return waiter.taken
+            finally:
+                self._waiters -= 1
+                if waiter.taken is None:
+                    self._queue.remove(waiter)
+                    heapq.heapify(self._queue)
+                    # the next in line might be able to go now
+                    self._handoff()
+
+    def _check_open(self):
+        if self._closed:
+            raise PoolClosed("The resource pool has been closed.")
+
+    def _check_waiters(self):
+        """ Raises PoolExhausted if a caller can't wait because 'max_waiters'
+        callers already are. Must be called with the lock held.
+        """
+        if self._max_waiters is not None and self._waiters >= self._max_waiters:
+            self._rejected += 1
+            raise PoolExhausted(
+                "{} callers are already waiting for a resource.".format(self._waiters))
+
+    def _check_circuit(self):
+        """ Raises CircuitOpen while the circuit breaker is open. Must be
+        called with the lock held.
+        """
+        if self._open_until is not None and not self._cooled_down():
+            self._rejected += 1
+            raise CircuitOpen("Too many return callbacks failed, the pool is "
+                              "turning callers away for now.")
+
+    def _cooled_down(self):
+        """ Half opens an open circuit once 'breaker_cooldown' has passed, the
+        next callback to finish then decides. Returns True if it did. Must be
+        called with the lock held.
+        """
+        if time.monotonic() < self._open_until:
+            return False
+        self._open_until = None
+        self._half_open = True
+        return True
+
+    def _record_callback_result(self, failed):
+        """ Feeds the result of a return callback to the circuit breaker.
+        Must be called with the lock held.
+        """
+        if self._open_until is not None and not self._cooled_down():
+            return
+        if self._half_open:
+            self._half_open = False
+            if failed:
+                self._open_circuit()
+            return
+        results = self._breaker_results
+        results.append(failed)
+        if len(results) == results.maxlen and \
+                sum(results) >= self._breaker_failure_rate * len(results):
+            self._open_circuit()
+
+    def _open_circuit(self):
+        self._open_until = time.monotonic() + self._breaker_cooldown
+        self._breaker_results.clear()
+        # the waiters fail fast too
+        self._wake_all()
+
+    def circuit_state(self):
+        """ Returns 'closed', 'open' or 'half_open' (cooled down and waiting
+        for a callback to decide), always 'closed' without a circuit breaker.
+        """
+        with self._lock:
+            if self._open_until is not None and not self._cooled_down():
+                return 'open'
+            return 'half_open' if self._half_open else 'closed'
+
+    def _handoff(self):
+        """ Hands objects to the callers at the head of the fair queue. Must be
+        called with the lock held.
+        """
+        while self._queue:
+            head = self._queue[0]
+            taken = self._try_take(head.n, head.affinity)
+            if taken is None:
+                return
+            heapq.heappop(self._queue)
+            head.taken = taken
+            head.cond.notify()
+
+    def _record_acquire(self, objs, start):
+        now = time.monotonic()
+        if self._track:
+            holder = current_thread().name
+            stack = _acquiring_stack() if self._capture_stack else None
+        with self._lock:
+            if self._metrics:
+                self._wait_times.record(now - start)
+            for obj in objs:
+                meta = self._records[id(obj)]
+                meta.checked_out_at = now
+                if self._track:
+                    meta.holder = holder
+                    meta.stack = stack
+                    meta.leak_reported = False
+        if self._listeners:
+            for obj in objs:
+                self._call_listeners('on_acquire', obj, now - start)
+
+    def _record_return(self, objs):
+        now = time.monotonic()
+        holds = []
+        with self._lock:
+            for obj in objs:
+                meta = self._records.get(id(obj))
+                if meta is None or meta.checked_out_at is None:
+                    continue
+                holds.append((obj, now - meta.checked_out_at))
+                meta.checked_out_at = None
+                meta.holder = None
+                meta.stack = None
+                if self._metrics:
+                    self._hold_times.record(holds[-1][1])
+        if self._listeners:
+            for obj, hold in holds:
+                self._call_listeners('on_return', obj, hold)
+
+    def _call_listeners(self, event, *args):
+        for listener in self._listeners:
+            try:
+                getattr(listener, event)(self, *args)
+            except Exception:
+                traceback.print_exc()
+
+    def add_listener(self, listener):
+        """ Adds a PoolListener (see pyresourcepool.metrics) to be told about
+        acquires, returns, removals and completed return callbacks.
+        """
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+            self._instrumented = True
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners = [x for x in self._listeners if x is not listener]
+            self._instrumented = self._metrics or self._track or bool(self._listeners)
+
+    def checked_out(self):
+        """
+        Returns a list of dicts describing the objects that are checked out,
+        if the pool was created with 'track_checkouts' (otherwise it is
+        empty), longest held first:
+          - 'resource': the object
+          - 'thread': name of the thread that checked it out
+          - 'held': seconds since it was checked out
+          - 'stack': a traceback.StackSummary of where it was checked out
+            from, if the pool was created with 'capture_stack', else None
+        """
+        now = time.monotonic()
+        with self._lock:
+            checked_out = [{
+                'resource': rec.obj,
+                'thread': rec.holder,
+                'held': now - rec.checked_out_at,
+                'stack': rec.stack,
+            } for rec in self._records.values()
+                if rec.checked_out_at is not None and rec.holder is not None]
+        checked_out.sort(key=lambda c: -c['held'])
+        return checked_out
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool's state and counters as a dict:
+          - 'size': objects in the pool (not removed)
+          - 'available': objects ready to be handed out
+          - 'checked_out': objects handed out and not returned yet
+          - 'in_callback': objects whose return callback is running/queued
+          - 'removed': objects removed from the pool so far
+          - 'waiters': callers waiting for a resource
+          - 'acquires': objects handed out so far
+          - 'timeouts': waits that ended with ResourceTimeout
+          - 'callback_failures': return callbacks that raised an exception
+          - 'rejected': acquisitions turned away with PoolExhausted or
+            CircuitOpen
+        and if the pool was created with 'metrics=True', summaries of the
+        'wait_time', 'hold_time' and 'callback_time' histograms (seconds).
+        """
+        with self._lock:
+            stats = {
+                'size': self._active,
+                'available': len(self._available),
+                'checked_out': max(self._active - len(self._available) - self._in_callback, 0),
+                'in_callback': self._in_callback,
+                'removed': self._removed_count,
+                'waiters': self._waiters,
+                'acquires': self._acquires,
+                'timeouts': self._timeouts,
+                'callback_failures': self._callback_failures,
+                'rejected': self._rejected,
+            }
+            if self._metrics:
+                stats['wait_time'] = self._wait_times.snapshot()
+                stats['hold_time'] = self._hold_times.snapshot()
+                stats['callback_time'] = self._callback_times.snapshot()
+        return stats
+
+    def _wait(self, expires):
+        """ Waits to be notified, raising ResourceTimeout if 'expires' has
+        passed. Must be called with the lock held.
+        """
+        self._waiters += 1
+        self._waits += 1
+        try:
+            if expires is None:
+                self._cond.wait()
+                return
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                self._timeouts += 1
+                raise ResourceTimeout(
+                    "Timed out waiting for a resource from the pool.")
+            self._cond.wait(remaining)
+        finally:
+            self._waiters -= 1
+
+    def get_resources_unmanaged(self, n, block=True, timeout=None, deadline=None,
+                                priority=0, key=None):
+        """
+        Gets 'n' resources from the pool at once, see get_resource_unmanaged().
+        Either all 'n' objects are handed out or, while waiting, none are held
+        so callers needing several resources can't deadlock each other by
+        each holding part of what they need. It is up to you to return them
+        to the pool, return_resources() does that in one go.
+
+        Returns a list of 'n' objects, or None if 'block' is False and there
+        aren't 'n' available. 'timeout', 'deadline', 'priority' and 'key'
+        work in the same way as for get_resource_unmanaged().
+        """
+        if n < 1:
+            raise ValueError("'n' must be at least 1.")
+        expires = _expiry(timeout, deadline)
+        start = time.monotonic() if self._instrumented else None
 
-            if obj or (not block):
+        while True:
+            objs = self._take_many(n, block, expires, priority, key)
+            if objs is None:
+                return None
+            unhealthy = [obj for obj in objs if self._needs_borrow_check(obj) and
+                         not self._check(obj)]
+            if not unhealthy:
                 break
-            time.sleep(0.1)
+            # put the healthy ones back and try again for the whole batch
+            unhealthy = set(id(obj) for obj in unhealthy)
+            for obj in objs:
+                if id(obj) in unhealthy:
+                    self._discard_unhealthy(obj)
+            self.return_resources([obj for obj in objs if id(obj) not in unhealthy],
+                                  force=True)
+        if start is not None:
+            self._record_acquire(objs, start)
+        return objs
+
+    def _take_many(self, n, block, expires, priority, key):
+        taken = self._take(n, block, expires, priority, key)
+        if taken is None:
+            return None
+        objs, grow = taken
+        for i in range(grow):
+            try:
+                objs.append(self._create())
+            except BaseException:
+                with self._lock:
+                    # release the slots of the objects not created yet
+                    self._creating -= grow - i - 1
+                    self._capacity_freed()
+                self.return_resources(objs, force=True)
+                raise
+        return objs
 
+    def _create(self, available=False):
+        """ Creates a new object with the factory, outside of the pool lock, and
+        makes it a member of the pool already checked out to the caller, or
+        available in the pool if 'available' is True. The caller must have
+        reserved the slot by incrementing self._creating.
+        """
+        try:
+            obj = self._factory()
+        except BaseException:
+            with self._lock:
+                self._creating -= 1
+                self._capacity_freed()
+                # let someone else have a go at creating an object
+                self._notify()
+                if self._closed:
+                    self._callbacks_done.notify_all()
+            raise
+        retired = False
+        with self._lock:
+            self._creating -= 1
+            self._register(obj)
+            if available:
+                # destroyed straight away if the pool was closed meanwhile
+                retired = self._make_available(obj)
+            else:
+                self._records[id(obj)].use_count += 1
+                self._acquires += 1
+        if retired:
+            self._destroy_objects([obj])
         return obj
 
     def return_resource(self, obj, force=False):
@@ -140,60 +1403,470 @@ class ResourcePool(object):
             not None
           OR
           - self._return_callback is not None
-        then start a thread that calls that callback before returning the resource
-        to the pool. This allows the calling process to not have to wait for that
-        pre-return-to-pool operation (eg. factory reset of a device that is being
-        tested).
+        then have one of the pool's callback workers call that callback before
+        returning the resource to the pool. This allows the calling process to
+        not have to wait for that pre-return-to-pool operation (eg. factory reset
+        of a device that is being tested). If 'callback_queue_size' was given
+        when creating the pool this blocks while that many callbacks are
+        already waiting for a worker.
 
         NOTE: the callback added as a property to the object gets precedence
               over the one specified for the pool.
         NOTE: the callback property is stripped from the obj during the return
               process.
         """
-        if (not obj) or (obj not in self._objects):
+        if id(obj) not in self._records:
             raise ObjectNotInPool("Object {} not a member of the pool".format(str(obj)))
+        self._put_back(obj, None if force else self._take_callback(obj), force)
 
-        if not force:
-            callback = None
-            if hasattr(obj, CALLBACK_ATTRIBUTE) and \
-                    getattr(obj, CALLBACK_ATTRIBUTE) is not None:
-                callback = getattr(obj, CALLBACK_ATTRIBUTE)
-                # strip the callback attribute from the object
-                delattr(obj, CALLBACK_ATTRIBUTE)
-            elif self._return_callback:
-                callback = self._return_callback
-            if callback:
-                thread = Thread(target=self._run_return_callback, args=(obj, callback))
-                thread.setName("return_obj_{}".format(id(obj)))
-                thread.start()
-                return
+    def _return_leased(self, obj, callback, discard):
+        """ Returns the resource of a Lease, with the callback set by its
+        on_return() or the pool's, or takes it out of the pool if the lease
+        was discarded.
+        """
+        if id(obj) not in self._records:
+            raise ObjectNotInPool("Object {} not a member of the pool".format(str(obj)))
+        if discard:
+            if self._instrumented:
+                self._record_return([obj])
+            self._discard_unhealthy(obj)
+            return
+        self._put_back(obj, callback or self._return_callback, False)
+
+    def _put_back(self, obj, callback, force):
+        """ return_resource() once the return callback to run is known. """
+        if self._instrumented:
+            self._record_return([obj])
+
+        # no point getting an object ready for use once the pool is closed
+        if not force and not self._closed and (callback or self._validate_on_return):
+            self._dispatch_callbacks([(obj, callback)])
+            return
+
+        with self._lock:
+            retired = self._make_available(obj)
+        if retired:
+            self._destroy_objects([obj])
+
+    def return_resources(self, objs, force=False):
+        """
+        Returns several resources to the pool at once, see return_resource().
+        The objects that don't need a return callback are put back into the
+        pool under a single lock acquisition and the callbacks of the others
+        are run one after the other by a single callback worker.
+        """
+        for obj in objs:
+            if id(obj) not in self._records:
+                raise ObjectNotInPool("Object {} not a member of the pool".format(str(obj)))
+        if self._instrumented:
+            self._record_return(objs)
+
+        callbacks = []
+        if not force and not self._closed:
+            for obj in objs:
+                callback = self._take_callback(obj)
+                if callback or self._validate_on_return:
+                    callbacks.append((obj, callback))
+        if callbacks:
+            with_callback = set(id(obj) for obj, callback in callbacks)
+            objs = [obj for obj in objs if id(obj) not in with_callback]
 
         with self._lock:
-            if not self._removed[id(obj)]:
-                self._available.append(obj)
+            retired = [obj for obj in objs if self._make_available(obj)]
+        self._destroy_objects(retired)
+        if callbacks:
+            self._dispatch_callbacks(callbacks)
+
+    def _take_callback(self, obj):
+        """ Returns the return callback to run for 'obj', None if there isn't
+        one, stripping the object's own callback attribute.
+        """
+        if hasattr(obj, CALLBACK_ATTRIBUTE) and \
+                getattr(obj, CALLBACK_ATTRIBUTE) is not None:
+            callback = getattr(obj, CALLBACK_ATTRIBUTE)
+            # strip the callback attribute from the object
+            delattr(obj, CALLBACK_ATTRIBUTE)
+            return callback
+        return self._return_callback
+
+    def _make_available(self, obj):
+        """ Puts a returned object back into the pool unless it has been
+        removed. Must be called with the lock held. Returns True if the object
+        was retired instead, in which case the caller must destroy it once the
+        lock has been released.
+        """
+        meta = self._records.get(id(obj))
+        if meta is None:
+            # already returned
+            return False
+        if meta.removed:
+            self._drop(meta)
+            return False
+        if self._closed:
+            self._retire(obj)
+            return True
+        meta.last_returned_at = time.monotonic()
+        if not (meta.retiring or self._expired(meta, meta.last_returned_at)) or \
+                not self._can_retire():
+            if meta.retiring:
+                # the pool can't lose it after all
+                meta.retiring = False
+                meta.destroy = None
+                self._retiring -= 1
+            self._available.append(obj)
+            self._notify()
+            return False
+        self._retire(obj)
+        return True
+
+    def _start_warmups(self, objs):
+        """ Makes 'objs' members of the pool and has a callback worker warm
+        up each of them, they are made available as they finish.
+        """
+        with self._lock:
+            for o in objs:
+                self._register(o)
+            self._warming += len(objs)
+            self._in_callback += len(objs)
+            self._callbacks_in_flight += len(objs)
+        for o in objs:
+            # not limited by 'callback_queue_size', the constructor mustn't
+            # block
+            self._get_executor().submit(self._warm_up, o)
+
+    def _warm_up(self, obj):
+        try:
+            self._run_return_callback(obj, self._warmup)
+        except AllResourcesRemoved:
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._in_callback -= 1
+                self._warming -= 1
+                if id(obj) in self._records and not self._records[id(obj)].removed:
+                    self._warmed += 1
+                self._ready.notify_all()
+            self._callback_finished(slot=False)
+
+    def wait_ready(self, min_count=None, timeout=None):
+        """
+        Waits until 'min_count' of the objects given to the constructor have
+        been warmed up, or all of them if 'min_count' is None. Returns True
+        if they have, False if 'timeout' (seconds) expired first or too many
+        warm-ups failed for there to be 'min_count' of them.
+        """
+        with self._lock:
+            target = self._warm_total if min_count is None else min_count
+            self._ready.wait_for(
+                lambda: self._warmed >= target or self._warmed + self._warming < target,
+                timeout)
+            return self._warmed >= target
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._callback_workers,
+                    thread_name_prefix="resource_pool_callback")
+            return self._executor
+
+    def _dispatch_callbacks(self, callbacks):
+        """ Hands a list of (obj, callback) pairs to the callback executor as
+        a single task, blocking while the callback queue is full.
+        """
+        if self._callback_slots is not None:
+            self._callback_slots.acquire()
+        with self._lock:
+            self._callbacks_in_flight += 1
+            self._in_callback += len(callbacks)
+        try:
+            self._get_executor().submit(self._callback_task, callbacks)
+        except Exception:
+            with self._lock:
+                self._in_callback -= len(callbacks)
+            self._callback_finished()
+            raise
+
+    def _callback_task(self, callbacks):
+        try:
+            for obj, callback in callbacks:
+                try:
+                    self._run_return_callback(obj, callback)
+                except AllResourcesRemoved:
+                    # raised by remove() when the last object failed its
+                    # callback, the waiters have been told already
+                    traceback.print_exc()
+                finally:
+                    with self._lock:
+                        self._in_callback -= 1
+        finally:
+            self._callback_finished()
+
+    def _callback_finished(self, slot=True):
+        if slot and self._callback_slots is not None:
+            self._callback_slots.release()
+        with self._lock:
+            self._callbacks_in_flight -= 1
+            if self._callbacks_in_flight == 0:
+                self._callbacks_done.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Waits for the return callbacks that have been started to finish, so
+        every object returned so far is either back in the pool or removed.
+
+        Returns True if they all finished or False if 'timeout' (seconds)
+        expired first.
+        """
+        with self._lock:
+            return self._callbacks_done.wait_for(
+                lambda: self._callbacks_in_flight == 0, timeout)
+
+    def close(self, timeout=None):
+        """
+        Shuts the pool down. From now on getting a resource or adding one
+        raises PoolClosed, and so do the calls that were waiting for one. The
+        idle objects are retired straight away and the rest as they come
+        back, checked out objects when they are returned (without running
+        their return callback) and the others when their return callback or
+        warm-up finishes. Every retired object is destroyed with 'destroy'.
+
+        Waits until that is done for every object and then stops the reaper
+        thread and shuts down the callback worker threads if the pool created
+        them. Returns True if everything was done within 'timeout' (seconds),
+        False if objects are still out, they are destroyed when they come
+        back. Calling close() again waits again.
+
+        The pool can also be used in a 'with' statement, which closes it at
+        the end:
+
+            with ResourcePool(objects, destroy=disconnect) as pool:
+                serve(pool)
+        """
+        retired = self._shut()
+        self._destroy_objects(retired)
+        self._reaper_stop.set()
+        closed = self._wait_closed(timeout)
+        with self._lock:
+            executor = self._executor if self._owns_executor else None
+            if executor is not None:
+                self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=closed)
+        return closed
+
+    def _shut(self):
+        """ Marks the pool closed, wakes the waiters so they raise PoolClosed
+        and retires the idle objects. Returns the objects retired, for the
+        caller to destroy.
+        """
+        with self._lock:
+            self._closed = True
+            self._wake_all()
+            retired = list(self._available)
+            for obj in retired:
+                self._retire(obj)
+        return retired
+
+    def _wait_closed(self, timeout):
+        """ Waits for every object of a closed pool to have been retired and
+        every callback to have finished, True if they were within 'timeout'.
+        """
+        with self._lock:
+            return self._callbacks_done.wait_for(
+                lambda: self._active == 0 and self._creating == 0 and
+                self._callbacks_in_flight == 0, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _run_return_callback(self, obj, callback):
         """ This should only really be called by self.return_resource() and is intended
-        to be run in a thread to perform some pre-returnn-to-pool process without
+        to be run in a callback worker thread to perform some pre-returnn-to-pool process without
         the process that used the resource having to wait for that operation to occur.
 
         If running the callback raises an exception the resource will be removed from
         the pool.
         """
+        if callback:
+            start = time.monotonic() if self._instrumented else None
+            try:
+                callback(obj)
+            except Exception as e:
+                traceback.print_exc()
+                self._callback_complete(obj, start, e)
+                self._remove(obj, gone=True)
+                return
+            self._callback_complete(obj, start, None)
+        if self._validate_on_return and not self._check(obj):
+            self._discard_unhealthy(obj)
+            return
+        self.return_resource(obj, force=True)
+
+    def _callback_complete(self, obj, start, error):
+        with self._lock:
+            if error is not None:
+                self._callback_failures += 1
+            if self._breaker_failure_rate is not None:
+                self._record_callback_result(error is not None)
+            if start is not None and self._metrics:
+                self._callback_times.record(time.monotonic() - start)
+        if start is not None and self._listeners:
+            self._call_listeners('on_callback_complete', obj,
+                                 time.monotonic() - start, error)
+
+    def snapshot(self, identify, path=None):
+        """
+        Returns the state of the pool as a dict that can be stored as JSON,
+        and writes it to the file 'path' if given, so that restore() can
+        rebuild the pool after a restart. 'identify' is called with each
+        object and returns something JSON can store that identifies it, eg.
+        a device's serial number.
+
+        Each object is listed, idle objects first in the order they'd be
+        handed out, with its 'id', 'uses' (times handed out), 'age' (seconds
+        since it joined the pool) and 'state':
+          - 'available': idle in the pool and ready for use
+          - 'out': checked out or in its return callback, so it might not
+            have been reset
+          - 'removed': removed from the pool while it was checked out
+        Objects removed before that are forgotten by the pool and not listed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = list(self._available)
+            idle = set(id(o) for o in available)
+            records = [self._records[id(o)] for o in available] + \
+                [rec for ident, rec in self._records.items() if ident not in idle]
+            entries = [(rec.obj, 'removed' if rec.removed else
+                        'available' if id(rec.obj) in idle else 'out',
+                        rec.use_count, now - rec.created_at) for rec in records]
+        # identify() is the caller's code, run without the lock held
+        snapshot = {
+            'version': 1,
+            'objects': [{'id': identify(obj), 'state': state, 'uses': uses,
+                         'age': round(age, 3)}
+                        for obj, state, uses, age in entries],
+        }
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+        return snapshot
+
+    @classmethod
+    def restore(cls, snapshot, resolver, **kwargs):
+        """
+        Creates a pool from what snapshot() returned, or the path of the file
+        it wrote. 'resolver' is called with the 'id' of each object and
+        returns the object, or None if it is gone. The rest of the arguments
+        are those of the constructor.
+
+        Objects that were 'available' go straight back into the pool, keeping
+        their use counts and ages, without running 'warmup' or the return
+        callback on them. Those that were 'out' are put through the return
+        callback first, as if they were being returned, and 'removed' ones
+        are left out. A pool with a factory is then topped up to 'min_size'.
+        """
+        if not isinstance(snapshot, dict):
+            with open(snapshot) as f:
+                snapshot = json.load(f)
+        if snapshot.get('version') != 1:
+            raise ValueError("Unknown snapshot version {}.".format(snapshot.get('version')))
+        # topped up once the restored objects are in
+        min_size = kwargs.pop('min_size', 0)
+        if min_size and kwargs.get('factory') is None:
+            raise ValueError("'min_size' needs a 'factory' to create objects.")
+        if kwargs.get('max_size') is not None and min_size > kwargs['max_size']:
+            raise ValueError("'min_size' can't be larger than 'max_size'.")
+        pool = cls(**kwargs)
+        restored = []
+        for entry in snapshot['objects']:
+            if entry['state'] == 'removed':
+                continue
+            obj = resolver(entry['id'])
+            if obj is not None:
+                restored.append((obj, entry))
+        now = time.monotonic()
+        dirty = []
+        with pool._lock:
+            for obj, entry in restored:
+                pool._register(obj)
+                rec = pool._records[id(obj)]
+                rec.use_count = entry['uses']
+                rec.created_at = now - entry['age']
+                if entry['state'] == 'available':
+                    pool._available.append(obj)
+                    pool._notify()
+                else:
+                    dirty.append(obj)
+        if dirty:
+            pool.return_resources(dirty)
+        if min_size:
+            pool._min_size = min_size
+            pool._reap()
+        return pool
+
+    def lease(self, block=True, timeout=None, deadline=None, priority=0, key=None):
+        """
+        Like get_resource_unmanaged() but returns the object wrapped in a
+        Lease, whose release() returns it to the pool. If the Lease is
+        garbage collected without being released the object is returned to
+        the pool then, so a code path that forgets to return it doesn't lose
+        it for good. Returns None if 'block' is False and there is nothing
+        available.
+
+            lease = pool.lease()
+            use(lease.resource)
+            lease.release()
+        """
+        obj = self._get(block, timeout, deadline, priority, key)
+        if obj is _NO_RESOURCE:
+            return None
+        return Lease(self, obj)
+
+    @contextmanager
+    def get_resources(self, n, block=True, timeout=None, deadline=None, priority=0,
+                      key=None):
+        """
+        Intended to be used in a 'with' statement, gets 'n' resources from the
+        pool at once with get_resources_unmanaged() and returns them all with
+        return_resources() at the end of the 'with' block. eg:
+
+            with pool.get_resources(2, timeout=10) as (r1, r2):
+                do_stuff(r1, r2)
+
+        If 'block' is False, None is returned if there aren't 'n' available.
+        """
+        objs = None
         try:
-            callback(obj)
-            self.return_resource(obj, force=True)
-        except Exception:
-            traceback.print_exc()
-            self.remove(obj)
+            objs = self.get_resources_unmanaged(n, block=block, timeout=timeout,
+                                                deadline=deadline, priority=priority,
+                                                key=key)
+            yield objs
+        finally:
+            if objs is not None:
+                self.return_resources(objs)
 
     @contextmanager
-    def get_resource(self, block=True):
+    def get_resource(self, block=True, timeout=None, deadline=None, priority=0,
+                     key=None, lease=False):
         """
         Intended to be used in a 'with' statement or a contextlib.ExitStack.
 
         Returns an object from the pool and waits if necessary. If 'block' is
-        False, then None is returned if the pool has been depleted.
+        False, then None is returned if the pool has been depleted. See
+        get_resource_unmanaged() for the 'timeout', 'deadline', 'priority' and
+        'key' arguments.
+
+        If 'lease' is True a Lease holding the object is returned instead, to
+        set options for this checkout only. eg:
+
+            with pool.get_resource(lease=True) as lease:
+                if not send(lease.resource, request):
+                    lease.discard()
 
         Example useage:
 
@@ -202,10 +1875,20 @@ class ResourcePool(object):
             # at this point, outside the with block, the resource has
             # been returned to the pool.
         """
-        obj = None
+        obj = _NO_RESOURCE
+        leased = None
         try:
-            obj = self.get_resource_unmanaged(block=block)
-            yield obj
+            obj = self._get(block, timeout, deadline, priority, key)
+            if obj is _NO_RESOURCE:
+                yield None
+            elif lease:
+                # returned by the 'with' block, so no finalizer is needed
+                leased = Lease(self, obj, reclaim=False)
+                yield leased
+            else:
+                yield obj
         finally:
-            if obj:
+            if leased is not None:
+                leased.release()
+            elif obj is not _NO_RESOURCE:
                 self.return_resource(obj)
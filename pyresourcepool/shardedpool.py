@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+""" A resource pool whose available objects are split over several "stripes",
+each with its own lock, for pools used by many threads at once.
+"""
+
+import itertools
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Condition, Lock, RLock, local
+
+from pyresourcepool.pyresourcepool import (
+    CALLBACK_ATTRIBUTE,
+    AllResourcesRemoved,
+    ObjectAlreadyInPool,
+    ObjectNotInPool,
+    ResourceTimeout,
+    _NO_RESOURCE,
+    _Resource,
+    _expiry,
+)
+
+
+class _Stripe(object):
+    """ Part of the available objects and the lock guarding them. """
+    __slots__ = ('lock', 'items')
+
+    def __init__(self):
+        self.lock = Lock()
+        # keyed by id() like FifoStrategy so removal is O(1)
+        self.items = OrderedDict()
+
+
+class ShardedResourcePool(object):
+    def __init__(self, objects=(), return_callback=None, stripes=None,
+                 callback_workers=None, callback_executor=None):
+        """
+        Instantiate with a list of objects you want in the resource pool.
+
+        This pool behaves like ResourcePool but is meant for many threads
+        holding resources for a short time, where the single lock of
+        ResourcePool becomes the bottleneck. The available objects are split
+        over 'stripes' lists (by default one per CPU), each with its own lock.
+        Each thread has a "home" stripe: it takes objects from it and returns
+        them to it, and only when it is empty looks through the other
+        stripes. So getting and returning an object normally only takes a
+        lock that no other thread is using. Only when no stripe has an object
+        does a caller take the pool wide lock and wait.
+
+        add(), remove() and AllResourcesRemoved work as they do for
+        ResourcePool, as do return callbacks ('return_callback' and the
+        'resource_pool_return_callback' attribute of objects), which are run
+        by a pool of 'callback_workers' threads or by 'callback_executor'.
+        Factories, health checks, fairness, strategies and metrics are not
+        supported, use ResourcePool for those.
+        """
+        if stripes is None:
+            stripes = os.cpu_count() or 1
+        if stripes < 1:
+            raise ValueError("'stripes' must be at least 1.")
+        self._stripes = [_Stripe() for i in range(stripes)]
+        # the home stripe of each thread, handed out round robin
+        self._local = local()
+        self._next_stripe = itertools.count()
+        # the _Resource record of each object in the pool, dropped once the
+        # object has left the pool and isn't checked out, as for ResourcePool
+        self._records = {}
+        self._active = 0
+        # guards membership and the waiters, taken before a stripe lock
+        self._lock = RLock()
+        self._cond = Condition(self._lock)
+        # read without the lock on the return path, see return_resource()
+        self._waiters = 0
+        self._timeouts = 0
+        self._return_callback = return_callback
+        if callback_workers is None:
+            callback_workers = min(32, (os.cpu_count() or 1) + 4)
+        self._callback_workers = callback_workers
+        self._executor = callback_executor
+        self._owns_executor = callback_executor is None
+        self.add(list(OrderedDict((id(o), o) for o in objects).values()))
+
+    def _home(self):
+        try:
+            return self._local.stripe
+        except AttributeError:
+            stripe = self._local.stripe = \
+                self._stripes[next(self._next_stripe) % len(self._stripes)]
+            return stripe
+
+    def _take(self):
+        """ Takes an object from the home stripe, or from any other stripe if
+        that is empty. Returns _NO_RESOURCE if none of them have one.
+        """
+        home = self._home()
+        with home.lock:
+            if home.items:
+                return home.items.popitem(last=False)[1]
+        for stripe in self._stripes:
+            if stripe is home or not stripe.items:
+                continue
+            with stripe.lock:
+                if stripe.items:
+                    return stripe.items.popitem(last=False)[1]
+        return _NO_RESOURCE
+
+    def all_removed(self):
+        return self._active == 0
+
+    def add(self, obj):
+        """
+        Adds new objects to the pool, 'obj' can be a single object or a list of
+        objects. They are spread over the stripes.
+        """
+        if type(obj) is not list:
+            obj = [obj]
+        with self._lock:
+            for o in obj:
+                if o is None:
+                    raise ValueError("None can't be a resource, it means 'no resource'.")
+                if id(o) in self._records:
+                    raise ObjectAlreadyInPool("Object is already in the pool.")
+                self._records[id(o)] = _Resource(o, 0)
+                self._active += 1
+                stripe = self._stripes[next(self._next_stripe) % len(self._stripes)]
+                with stripe.lock:
+                    stripe.items[id(o)] = o
+            self._cond.notify_all()
+
+    def remove(self, obj):
+        """
+        Removes an object from the pool so that it can't be handed out as an
+        available resource again. If the object passed in is not in the pool
+        an ObjectNotInPool exception is raised.
+        """
+        self._remove(obj, gone=False)
+
+    def _remove(self, obj, gone):
+        """ remove(), 'gone' being True if the caller has the object and
+        won't return it so it can be dropped straight away.
+        """
+        with self._lock:
+            rec = self._records.get(id(obj))
+            if rec is None:
+                raise ObjectNotInPool("Object is not in the list of pool objects.")
+            if not rec.removed:
+                # marked before looking through the stripes, so an object
+                # being returned right now either sees the mark or is found
+                rec.removed = True
+                self._active -= 1
+            for stripe in self._stripes:
+                with stripe.lock:
+                    if stripe.items.pop(id(obj), _NO_RESOURCE) is not _NO_RESOURCE:
+                        gone = True
+                        break
+            if gone:
+                self._records.pop(id(obj), None)
+            all_removed = self.all_removed()
+            if all_removed:
+                self._cond.notify_all()
+        if all_removed:
+            raise AllResourcesRemoved(
+                "All resources have been removed. "
+                "Further use of the resource pool is void.")
+
+    def get_resource_unmanaged(self, block=True, timeout=None, deadline=None):
+        """
+        Gets a resource from the pool but in an "unmanaged" fashion. It is
+        up to you to return the resource to the pool by calling
+        return_resource(). 'block', 'timeout' and 'deadline' work as they do
+        for ResourcePool.get_resource_unmanaged().
+        """
+        obj = self._get(block, timeout, deadline)
+        return None if obj is _NO_RESOURCE else obj
+
+    def _get(self, block, timeout, deadline):
+        """ get_resource_unmanaged() but returns _NO_RESOURCE rather than None
+        when there is nothing available.
+        """
+        obj = self._take()
+        if obj is not _NO_RESOURCE:
+            return obj
+        expires = _expiry(timeout, deadline)
+        with self._lock:
+            # counted before looking again so a return that misses this look
+            # sees the waiter and wakes it
+            self._waiters += 1
+            try:
+                while True:
+                    if self.all_removed():
+                        raise AllResourcesRemoved(
+                            "All resources have been removed. Further use of "
+                            "the resource pool is void unless new resources are"
+                            "added.")
+                    obj = self._take()
+                    if obj is not _NO_RESOURCE:
+                        return obj
+                    if not block:
+                        return _NO_RESOURCE
+                    if expires is None:
+                        self._cond.wait()
+                        continue
+                    remaining = expires - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise ResourceTimeout(
+                            "Timed out waiting for a resource from the pool.")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+    def return_resource(self, obj, force=False):
+        """ Returns a resource to the calling thread's stripe, running a return
+        callback on it first as ResourcePool.return_resource() does.
+        """
+        rec = self._records.get(id(obj))
+        if rec is None:
+            raise ObjectNotInPool("Object {} not a member of the pool".format(str(obj)))
+        if not force:
+            callback = None
+            if hasattr(obj, CALLBACK_ATTRIBUTE) and \
+                    getattr(obj, CALLBACK_ATTRIBUTE) is not None:
+                callback = getattr(obj, CALLBACK_ATTRIBUTE)
+                delattr(obj, CALLBACK_ATTRIBUTE)
+            elif self._return_callback:
+                callback = self._return_callback
+            if callback:
+                self._get_executor().submit(self._run_return_callback, obj, callback)
+                return
+
+        home = self._home()
+        with home.lock:
+            # checked under the stripe lock, see remove()
+            if rec.removed:
+                self._records.pop(id(obj), None)
+                return
+            home.items[id(obj)] = obj
+        if self._waiters:
+            with self._lock:
+                self._cond.notify()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._callback_workers,
+                    thread_name_prefix="resource_pool_callback")
+            return self._executor
+
+    def _run_return_callback(self, obj, callback):
+        try:
+            callback(obj)
+        except Exception:
+            traceback.print_exc()
+            try:
+                self._remove(obj, gone=True)
+            except AllResourcesRemoved:
+                # the waiters have been told already
+                traceback.print_exc()
+            return
+        self.return_resource(obj, force=True)
+
+    def stats(self):
+        """ Returns the 'size', 'available', 'waiters' and 'timeouts' of the
+        pool and the number of objects available in each stripe.
+        """
+        with self._lock:
+            stripes = [len(stripe.items) for stripe in self._stripes]
+            return {
+                'size': self._active,
+                'available': sum(stripes),
+                'waiters': self._waiters,
+                'timeouts': self._timeouts,
+                'stripes': stripes,
+            }
+
+    def close(self):
+        """ Shuts down the callback worker threads if the pool created them,
+        after waiting for the callbacks in progress.
+        """
+        with self._lock:
+            executor = self._executor if self._owns_executor else None
+            if executor is not None:
+                self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    @contextmanager
+    def get_resource(self, block=True, timeout=None, deadline=None):
+        """
+        Intended to be used in a 'with' statement, see
+        ResourcePool.get_resource().
+        """
+        obj = _NO_RESOURCE
+        try:
+            obj = self._get(block, timeout, deadline)
+            yield None if obj is _NO_RESOURCE else obj
+        finally:
+            if obj is not _NO_RESOURCE:
+                self.return_resource(obj)
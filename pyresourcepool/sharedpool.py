@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+""" A resource pool shared by several processes, eg. the workers of a
+gunicorn or multiprocessing server, so any process can use any resource.
+"""
+
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+from pyresourcepool.pyresourcepool import (
+    AllResourcesRemoved,
+    ObjectAlreadyInPool,
+    ObjectNotInPool,
+    ResourceTimeout,
+    _expiry,
+)
+
+# values of a token's slot other than the pid of the process holding it
+_FREE = 0
+_REMOVED = -1
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to someone else
+        return True
+    return True
+
+
+class SharedResourcePool(object):
+    def __init__(self, size, reclaim_interval=1.0, context=None):
+        """
+        A pool of 'size' resources shared between processes. The pool only
+        hands out "tokens", the ints 0 to size - 1, and each process maps a
+        token to its own handle on the resource, eg. devices[token]. Each
+        token is held by at most one process (and thread) at a time.
+
+        Create the pool in the parent process before starting the workers,
+        which get it either by being forked or as an argument to
+        multiprocessing.Process. The state of the tokens lives in a
+        multiprocessing.shared_memory block guarded by a process-shared
+        lock, so this needs python 3.8 or later. 'context' is the
+        multiprocessing context to create the lock in.
+
+        The slot of a checked out token holds the pid of the process that
+        has it. When a process dies without returning its tokens they are
+        reclaimed, by reclaim() or by callers that find no free token, who
+        also look for dead holders every 'reclaim_interval' seconds while
+        they wait.
+
+        The creating process should call unlink() once the pool is no longer
+        needed by any process to free the shared memory.
+        """
+        if shared_memory is None:
+            raise RuntimeError("SharedResourcePool needs multiprocessing.shared_memory "
+                               "(python 3.8 or later).")
+        if size < 1:
+            raise ValueError("'size' must be at least 1.")
+        if context is None:
+            context = multiprocessing.get_context()
+        self._size = size
+        self._reclaim_interval = reclaim_interval
+        self._shm = shared_memory.SharedMemory(create=True, size=size * 8)
+        # one signed 64 bit slot per token, all zero (_FREE) to start with
+        self._slots = self._shm.buf.cast('q')
+        self._cond = context.Condition(context.Lock())
+
+    def __getstate__(self):
+        # sent to a child process: attach to the same block by name
+        return {
+            'size': self._size,
+            'reclaim_interval': self._reclaim_interval,
+            'name': self._shm.name,
+            'cond': self._cond,
+        }
+
+    def __setstate__(self, state):
+        self._size = state['size']
+        self._reclaim_interval = state['reclaim_interval']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._slots = self._shm.buf.cast('q')
+        self._cond = state['cond']
+
+    def _check_token(self, token):
+        if type(token) is not int or not 0 <= token < self._size:
+            raise ObjectNotInPool("Token {} not a member of the pool".format(token))
+
+    def all_removed(self):
+        return all(self._slots[i] == _REMOVED for i in range(self._size))
+
+    def add(self, token):
+        """ Puts a token that was removed back into the pool. """
+        self._check_token(token)
+        with self._cond:
+            if self._slots[token] != _REMOVED:
+                raise ObjectAlreadyInPool("Token is already in the pool.")
+            self._slots[token] = _FREE
+            self._cond.notify()
+
+    def remove(self, token):
+        """
+        Removes a token from the pool so that it isn't handed out again, in
+        every process. If it is checked out it stays with its holder until it
+        is returned. AllResourcesRemoved is raised if it was the last token.
+        """
+        self._check_token(token)
+        with self._cond:
+            self._slots[token] = _REMOVED
+            all_removed = self.all_removed()
+            if all_removed:
+                self._cond.notify_all()
+        if all_removed:
+            raise AllResourcesRemoved(
+                "All resources have been removed. "
+                "Further use of the resource pool is void.")
+
+    def reclaim(self):
+        """ Returns the tokens held by processes that no longer exist to the
+        pool. Returns the list of tokens reclaimed.
+        """
+        with self._cond:
+            return self._reclaim()
+
+    def _reclaim(self):
+        reclaimed = []
+        for i in range(self._size):
+            pid = self._slots[i]
+            if pid > 0 and pid != os.getpid() and not _alive(pid):
+                self._slots[i] = _FREE
+                reclaimed.append(i)
+        if reclaimed:
+            self._cond.notify_all()
+        return reclaimed
+
+    def _try_take(self):
+        for i in range(self._size):
+            if self._slots[i] == _FREE:
+                self._slots[i] = os.getpid()
+                return i
+        return None
+
+    def get_resource_unmanaged(self, block=True, timeout=None, deadline=None):
+        """
+        Gets a token from the pool but in an "unmanaged" fashion, it is up to
+        you to return it with return_resource(). 'block', 'timeout' and
+        'deadline' work as they do for ResourcePool.get_resource_unmanaged().
+        """
+        expires = _expiry(timeout, deadline)
+        with self._cond:
+            reclaimed = False
+            while True:
+                if self.all_removed():
+                    raise AllResourcesRemoved(
+                        "All resources have been removed. Further use of "
+                        "the resource pool is void unless new resources are"
+                        "added.")
+                token = self._try_take()
+                if token is not None:
+                    return token
+                if not reclaimed:
+                    # only worth looking for dead holders once per wakeup
+                    reclaimed = True
+                    if self._reclaim():
+                        continue
+                if not block:
+                    return None
+                wait = self._reclaim_interval
+                if expires is not None:
+                    remaining = expires - time.monotonic()
+                    if remaining <= 0:
+                        raise ResourceTimeout(
+                            "Timed out waiting for a resource from the pool.")
+                    wait = min(wait, remaining)
+                if not self._cond.wait(wait):
+                    reclaimed = False
+
+    def return_resource(self, token):
+        """ Returns a token checked out by this process to the pool. """
+        self._check_token(token)
+        with self._cond:
+            holder = self._slots[token]
+            if holder == _REMOVED:
+                return
+            if holder != os.getpid():
+                raise ObjectNotInPool(
+                    "Token {} is not checked out by this process".format(token))
+            self._slots[token] = _FREE
+            self._cond.notify()
+
+    def stats(self):
+        """ Returns the 'size' and 'available' tokens of the pool and
+        'holders', a dict of the pid holding each checked out token.
+        """
+        with self._cond:
+            slots = [self._slots[i] for i in range(self._size)]
+        return {
+            'size': sum(1 for s in slots if s != _REMOVED),
+            'available': sum(1 for s in slots if s == _FREE),
+            'holders': dict((i, s) for i, s in enumerate(slots) if s > 0),
+        }
+
+    def close(self):
+        """ Detaches this process from the shared memory. """
+        self._slots.release()
+        self._shm.close()
+
+    def unlink(self):
+        """ Detaches and frees the shared memory, done once by the creator. """
+        self.close()
+        self._shm.unlink()
+
+    @contextmanager
+    def get_resource(self, block=True, timeout=None, deadline=None):
+        """
+        Intended to be used in a 'with' statement, yields a token and returns
+        it at the end of the block. eg:
+
+            with pool.get_resource(timeout=10) as token:
+                use_device(devices[token])
+        """
+        token = None
+        try:
+            token = self.get_resource_unmanaged(block=block, timeout=timeout,
+                                                deadline=deadline)
+            yield token
+        finally:
+            if token is not None:
+                self.return_resource(token)
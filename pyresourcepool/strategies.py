@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+""" Strategies deciding which of the available objects the pool hands out
+next. A strategy holds the pool's available objects, so besides choosing it
+also does the bookkeeping, and every operation on it is O(1) (O(log n) for
+LruStrategy). Strategies are not thread safe, the pool only uses them with
+its lock held.
+
+Pick one by name when creating the pool, eg. ResourcePool(objects,
+strategy='lifo'), or pass an instance of your own subclass of FifoStrategy.
+"""
+
+import heapq
+import itertools
+from collections import OrderedDict
+from itertools import islice
+
+
+class FifoStrategy(object):
+    """ Hands out the object that has been available the longest, which
+    spreads use evenly over all of the objects. This is the default.
+
+    Objects are keyed by identity so that adding, taking and removing an
+    object never call the objects' own __eq__/__hash__.
+    """
+
+    def __init__(self, objects=()):
+        self._items = OrderedDict((id(o), o) for o in objects)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __contains__(self, obj):
+        return id(obj) in self._items
+
+    def __getitem__(self, index):
+        # O(index), only here so the tests can inspect the order of the
+        # queue with pool._available[n], the pool itself never indexes it
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError("available queue index out of range")
+        return next(islice(self._items.values(), index, None))
+
+    def append(self, obj):
+        """ Adds an object that has become available. """
+        self._items[id(obj)] = obj
+
+    def take(self, key=None):
+        """ Removes and returns the object to hand out next. 'key' is the
+        affinity key the caller passed to get_resource(), if any.
+        """
+        return self._items.popitem(last=False)[1]
+
+    def discard(self, obj):
+        """ Removes an object if it is available. """
+        self._items.pop(id(obj), None)
+
+    def forget(self, obj):
+        """ Drops anything kept about an object that has left the pool. """
+
+
+class LifoStrategy(FifoStrategy):
+    """ Hands out the most recently returned object. The busy objects stay
+    "hot" (in caches, connected) and the rest stay idle long enough for
+    'idle_timeout' to reap them when the pool is bigger than it needs to be.
+    """
+
+    def take(self, key=None):
+        return self._items.popitem(last=True)[1]
+
+
+class LruStrategy(FifoStrategy):
+    """ Hands out the object that was least recently handed out, regardless
+    of the order in which objects were returned.
+    """
+
+    def __init__(self, objects=()):
+        self._stamps = {}
+        self._counter = itertools.count()
+        # heap of (stamp, id) entries, entries that no longer match
+        # self._stamps or an available object are skipped when popped
+        self._heap = []
+        FifoStrategy.__init__(self)
+        for o in objects:
+            self.append(o)
+
+    def append(self, obj):
+        FifoStrategy.append(self, obj)
+        stamp = self._stamps.get(id(obj))
+        if stamp is None:
+            # never handed out, these go first in the order they were added
+            stamp = self._stamps[id(obj)] = next(self._counter)
+        heapq.heappush(self._heap, (stamp, id(obj)))
+
+    def take(self, key=None):
+        while True:
+            stamp, ident = heapq.heappop(self._heap)
+            if ident in self._items and self._stamps[ident] == stamp:
+                self._stamps[ident] = next(self._counter)
+                return self._items.pop(ident)
+
+    def discard(self, obj):
+        FifoStrategy.discard(self, obj)
+        if not self._items:
+            self._heap = []
+
+    def forget(self, obj):
+        self._stamps.pop(id(obj), None)
+
+
+class AffinityStrategy(FifoStrategy):
+    """ Prefers an object that was last handed out with the same 'key' (eg. a
+    tenant or database name) passed to get_resource(key=...), so whatever the
+    object cached for that key gets reused. Without a match it falls back to
+    the object that has been available the longest.
+    """
+
+    def __init__(self, objects=()):
+        # key each object was last handed out for, and the available objects
+        # for each key
+        self._keys = {}
+        self._by_key = {}
+        FifoStrategy.__init__(self)
+        for o in objects:
+            self.append(o)
+
+    def append(self, obj):
+        FifoStrategy.append(self, obj)
+        key = self._keys.get(id(obj))
+        if key is not None:
+            self._by_key.setdefault(key, OrderedDict())[id(obj)] = obj
+
+    def take(self, key=None):
+        matches = self._by_key.get(key) if key is not None else None
+        if matches:
+            # the most recently used for the key is the most likely to still
+            # have its cache warm
+            ident, obj = matches.popitem(last=True)
+            if not matches:
+                del self._by_key[key]
+            del self._items[ident]
+        else:
+            ident, obj = self._items.popitem(last=False)
+            self._discard_key(ident)
+        if key is not None:
+            self._keys[ident] = key
+        return obj
+
+    def discard(self, obj):
+        if id(obj) in self._items:
+            FifoStrategy.discard(self, obj)
+            self._discard_key(id(obj))
+
+    def forget(self, obj):
+        self._keys.pop(id(obj), None)
+
+    def _discard_key(self, ident):
+        key = self._keys.get(ident)
+        if key is None:
+            return
+        matches = self._by_key.get(key)
+        if matches is not None:
+            matches.pop(ident, None)
+            if not matches:
+                del self._by_key[key]
+
+
+STRATEGIES = {
+    'fifo': FifoStrategy,
+    'lifo': LifoStrategy,
+    'lru': LruStrategy,
+    'affinity': AffinityStrategy,
+}
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import time
+import pytest
+from pyresourcepool.pyresourcepool import (
+    AllResourcesRemoved, ObjectNotInPool, ResourceTimeout)
+from pyresourcepool.asyncpool import AsyncResourcePool
+
+
+class Person(object):
+    def __init__(self, name):
+        self.name = name
+
+
+async def do_callback_upper(obj):
+    await asyncio.sleep(0.2)
+    obj.name = obj.name.upper()
+
+
+def do_callback_lower(obj):
+    time.sleep(0.2)
+    obj.name = obj.name.lower()
+
+
+def do_callback_exception(obj):
+    raise ValueError("some random error")
+
+
+def make_pool(**kwargs):
+    return AsyncResourcePool([Person("John"),
+                              Person("Jim"),
+                              Person("Jake"),
+                              Person("Jason")], **kwargs)
+
+
+def test_async_pool_use():
+    async def main():
+        pool = make_pool()
+        async with pool.get_resource() as x:
+            assert x.name == "John"
+            assert len(pool._available) == 3
+        assert len(pool._available) == 4
+        assert pool._available[3].name == "John"
+
+        async def hold(t):
+            async with pool.get_resource():
+                await asyncio.sleep(t)
+
+        # more users than resources, everyone gets a turn
+        await asyncio.wait_for(
+            asyncio.gather(*[hold(0.05) for i in range(10)]), 5)
+        assert len(pool._available) == 4
+        assert len(pool._waiters) == 0
+    asyncio.run(main())
+
+
+def test_async_pool_waiters_served_in_order():
+    async def main():
+        pool = make_pool()
+        objs = [await pool.get_resource_unmanaged() for i in range(4)]
+        order = []
+
+        async def wait(i):
+            obj = await pool.get_resource_unmanaged()
+            order.append((i, obj))
+
+        tasks = [asyncio.ensure_future(wait(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        for o in objs[:3]:
+            pool.return_resource(o)
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        assert order == [(0, objs[0]), (1, objs[1]), (2, objs[2])]
+    asyncio.run(main())
+
+
+def test_async_pool_non_block_and_timeout():
+    async def main():
+        pool = make_pool()
+        for i in range(4):
+            await pool.get_resource_unmanaged()
+        async with pool.get_resource(block=False) as x:
+            assert x is None
+
+        start = time.monotonic()
+        with pytest.raises(ResourceTimeout):
+            await pool.get_resource_unmanaged(timeout=0.1)
+        assert time.monotonic() - start >= 0.1
+        with pytest.raises(ResourceTimeout):
+            await pool.get_resource_unmanaged(deadline=time.monotonic() + 0.05)
+        assert pool._timeouts == 2
+        assert len(pool._waiters) == 0
+    asyncio.run(main())
+
+
+def test_async_pool_cancelled_waiter_does_not_leak():
+    async def main():
+        pool = make_pool()
+        objs = [await pool.get_resource_unmanaged() for i in range(4)]
+        task = asyncio.ensure_future(pool.get_resource_unmanaged())
+        await asyncio.sleep(0)
+        # hand the object to the waiter and cancel it before it gets to run
+        pool.return_resource(objs[0])
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 1)
+        assert objs[0] in pool._available
+
+        # a waiter cancelled while still waiting is taken off the queue
+        held = await asyncio.wait_for(pool.get_resource_unmanaged(), 1)
+        assert held is objs[0]
+        task = asyncio.ensure_future(pool.get_resource_unmanaged())
+        await asyncio.sleep(0)
+        assert len(pool._waiters) == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 1)
+        assert len(pool._waiters) == 0
+    asyncio.run(main())
+
+
+def test_async_pool_removal():
+    async def main():
+        pool = make_pool()
+        for i in range(3):
+            async with pool.get_resource() as x:
+                pool.remove(x)
+        waiter = asyncio.ensure_future(pool.get_resource_unmanaged())
+        last = await pool.get_resource_unmanaged()
+        await asyncio.sleep(0)
+        with pytest.raises(AllResourcesRemoved):
+            pool.remove(last)
+        with pytest.raises(AllResourcesRemoved):
+            await asyncio.wait_for(waiter, 1)
+        with pytest.raises(AllResourcesRemoved):
+            async with pool.get_resource():
+                assert False
+        with pytest.raises(ObjectNotInPool):
+            pool.remove(Person("Jeff"))
+    asyncio.run(main())
+
+
+def test_async_pool_return_callbacks():
+    async def main():
+        pool = make_pool(return_callback=do_callback_upper)
+        async with pool.get_resource() as obj1:
+            async with pool.get_resource() as obj2:
+                # sync callbacks run in the executor
+                obj2.resource_pool_return_callback = do_callback_lower
+        assert obj1 not in pool._available
+        assert obj2 not in pool._available
+        await asyncio.sleep(0.4)
+        assert obj1.name == "JOHN"
+        assert obj2.name == "jim"
+        assert obj1 in pool._available
+        assert obj2 in pool._available
+
+        pool._return_callback = do_callback_exception
+        async with pool.get_resource() as obj3:
+            pass
+        await asyncio.sleep(0.1)
+        assert obj3 not in pool._available
+        assert id(obj3) not in pool._records
+    asyncio.run(main())
+
+
+class AsyncReset(object):
+    async def __call__(self, obj):
+        await asyncio.sleep(0.05)
+        obj.name = "reset"
+
+
+def test_async_pool_callbacks_returning_awaitables():
+    async def main():
+        pool = make_pool(return_callback=functools.partial(do_callback_upper))
+        async with pool.get_resource() as obj1:
+            async with pool.get_resource() as obj2:
+                obj2.resource_pool_return_callback = AsyncReset()
+        await asyncio.sleep(0.4)
+        assert obj1.name == "JOHN"
+        assert obj2.name == "reset"
+        assert obj1 in pool._available
+        assert obj2 in pool._available
+    asyncio.run(main())
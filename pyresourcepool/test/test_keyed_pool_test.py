@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import pytest
+from threading import Thread
+import time
+import pyresourcepool.pyresourcepool as rp
+from pyresourcepool.keyedpool import KeyedResourcePool
+
+
+class Conn(object):
+    def __init__(self, host):
+        self.host = host
+
+
+def test_keyed_pool_per_key_objects():
+    pool = KeyedResourcePool(factory=Conn)
+    with pool.get_resource('a') as a:
+        assert a.host == 'a'
+        with pool.get_resource('b') as b:
+            assert b.host == 'b'
+    # objects are reused within a key
+    with pool.get_resource('a') as a2:
+        assert a2 is a
+    assert sorted(pool.keys()) == ['a', 'b']
+    stats = pool.stats()
+    assert stats['size'] == 2
+    assert stats['acquires'] == 3
+    assert stats['keys']['a']['acquires'] == 2
+    assert stats['keys']['b']['size'] == 1
+    # every key shares the lock
+    assert pool.pool_for('a')._lock is pool.pool_for('b')._lock
+
+
+def test_keyed_pool_global_cap_evicts_idle():
+    destroyed = []
+    pool = KeyedResourcePool(factory=Conn, max_total=2, destroy=destroyed.append)
+    with pool.get_resource('a') as a:
+        pass
+    with pool.get_resource('b'):
+        pass
+    # at the cap, the idle object of another key is evicted to make room
+    with pool.get_resource('c') as c:
+        assert c.host == 'c'
+        assert destroyed == [a]
+        assert pool.stats()['size'] == 2
+    assert pool.stats()['keys']['a']['size'] == 0
+
+
+def test_keyed_pool_global_cap_waits():
+    pool = KeyedResourcePool(factory=Conn, max_total=1)
+    a = pool.get_resource_unmanaged('a')
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resource_unmanaged('b', timeout=0.1)
+
+    got = []
+    t = Thread(target=lambda: got.append(pool.get_resource_unmanaged('b', timeout=5)))
+    t.start()
+    time.sleep(0.1)
+    assert got == []
+    # once 'a' is idle the waiter for 'b' evicts it
+    pool.return_resource(a)
+    t.join(5)
+    assert got[0].host == 'b'
+    assert pool.stats()['size'] == 1
+
+
+def test_keyed_pool_add_remove():
+    pool = KeyedResourcePool()
+    c1, c2 = Conn('a'), Conn('a')
+    pool.add('a', [c1, c2])
+    with pytest.raises(rp.ObjectAlreadyInPool):
+        pool.add('b', c1)
+    with pytest.raises(KeyError):
+        pool.get_resource_unmanaged('b')
+    with pytest.raises(rp.ObjectNotInPool):
+        pool.return_resource(Conn('a'))
+    pool.remove(c1)
+    with pool.get_resource('a') as obj:
+        assert obj is c2
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.remove(c2)
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.get_resource_unmanaged('a')
+
+
+def test_keyed_pool_close():
+    destroyed = []
+    with KeyedResourcePool(factory=Conn, destroy=destroyed.append) as pool:
+        with pool.get_resource('a'):
+            pass
+        b = pool.get_resource_unmanaged('b')
+        t = Thread(target=lambda: (time.sleep(0.2), pool.return_resource(b)))
+        t.start()
+    # closing waited for 'b' to be returned
+    t.join()
+    assert sorted(c.host for c in destroyed) == ['a', 'b']
+    with pytest.raises(rp.PoolClosed):
+        pool.get_resource_unmanaged('a')
+    with pytest.raises(rp.PoolClosed):
+        pool.get_resource_unmanaged('c')
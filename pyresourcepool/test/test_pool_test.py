@@ -296,10 +296,11 @@ def test_pool_return_with_callback_exception(pool_with_callback_exception):
     time.sleep(1)
     assert obj1.name == "John"
     assert obj1 not in pool_with_callback_exception._available
-    assert pool_with_callback_exception._removed[id(obj1)]
+    # removed objects are dropped from the pool's records
+    assert id(obj1) not in pool_with_callback_exception._records
     assert obj2.name == "Jim"
     assert obj2 not in pool_with_callback_exception._available
-    assert pool_with_callback_exception._removed[id(obj2)]
+    assert id(obj2) not in pool_with_callback_exception._records
 
 
 def test_pool_return_with_obj_callback_ok(pool_with_callback_ok):
@@ -358,3 +359,1051 @@ def test_return_object_not_in_pool(pool, pool_with_callback_ok):
         pool_with_callback_ok.return_resource(obj1)
         # we should not make it to this bad assertion
         assert False
+
+
+def test_blocked_waiter_woken_on_return(pool):
+    objs = [pool.get_resource_unmanaged() for i in range(4)]
+    got = []
+    t = Thread(target=lambda: got.append(pool.get_resource_unmanaged()))
+    t.start()
+    time.sleep(0.05)
+    assert got == []
+
+    start = time.monotonic()
+    pool.return_resource(objs[0])
+    t.join(1)
+    # no polling interval to wait out, the waiter is handed the object
+    # straight away
+    assert time.monotonic() - start < 0.09
+    assert got == [objs[0]]
+
+
+def test_blocked_waiters_raise_when_all_removed(pool):
+    objs = [pool.get_resource_unmanaged() for i in range(4)]
+    errors = []
+
+    def wait_for_resource():
+        try:
+            pool.get_resource_unmanaged()
+        except rp.AllResourcesRemoved:
+            errors.append(time.monotonic())
+
+    threads = [Thread(target=wait_for_resource) for i in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+
+    for o in objs[:-1]:
+        pool.remove(o)
+    start = time.monotonic()
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.remove(objs[-1])
+    for t in threads:
+        t.join(1)
+    assert len(errors) == 3
+    assert all(e - start < 0.09 for e in errors)
+
+
+def test_get_resource_timeout(pool):
+    objs = [pool.get_resource_unmanaged() for i in range(4)]
+    start = time.monotonic()
+    with pytest.raises(rp.ResourceTimeout):
+        with pool.get_resource(timeout=0.2):
+            # we should not get to this bad assertion because an exception
+            # should be raised
+            assert False
+    assert 0.2 <= time.monotonic() - start < 1
+    assert pool._timeouts == 1
+
+    start = time.monotonic()
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resource_unmanaged(deadline=start + 0.1)
+    assert 0.1 <= time.monotonic() - start < 1
+    assert pool._timeouts == 2
+
+    # the earlier of the timeout and deadline wins
+    start = time.monotonic()
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resource_unmanaged(timeout=5, deadline=start + 0.1)
+    assert time.monotonic() - start < 1
+
+    # a resource returned before the timeout is handed out
+    Thread(target=lambda: (time.sleep(0.1), pool.return_resource(objs[0]))).start()
+    with pool.get_resource(timeout=1) as x:
+        assert x is objs[0]
+    assert pool._timeouts == 3
+
+
+def test_pool_membership_is_by_identity():
+    class Equal(object):
+        def __eq__(self, other):
+            return True
+
+        __hash__ = object.__hash__
+
+    objs = [Equal(), Equal()]
+    pool = rp.ResourcePool(objs)
+    pool.add(Equal())
+    assert len(pool._available) == 3
+
+    pool.remove(objs[1])
+    assert objs[1] not in pool._available
+    assert objs[0] in pool._available
+    assert pool.get_resource_unmanaged() is objs[0]
+
+
+def test_pool_duplicate_objects_at_construction():
+    objs = [Person("John"), Person("Jim")]
+    pool = rp.ResourcePool([objs[0], objs[1], objs[0]])
+    # the same object is only in the pool once so it can't be handed out
+    # twice at the same time
+    assert len(pool._available) == 2
+    assert pool.get_resource_unmanaged(block=False) is objs[0]
+    assert pool.get_resource_unmanaged(block=False) is objs[1]
+    assert pool.get_resource_unmanaged(block=False) is None
+
+    # add() changes to the pool are not made to the caller's list
+    pool.add(Person("Jake"))
+    assert len(objs) == 2
+
+
+def test_pool_callback_workers_bounded():
+    running = []
+    peak = []
+
+    def slow_reset(obj):
+        running.append(obj)
+        peak.append(len(running))
+        time.sleep(0.1)
+        running.remove(obj)
+
+    pool = rp.ResourcePool([Person("John"), Person("Jim"), Person("Jake"),
+                            Person("Jason")],
+                           return_callback=slow_reset, callback_workers=2,
+                           callback_queue_size=1)
+    objs = [pool.get_resource_unmanaged() for i in range(4)]
+    start = time.monotonic()
+    for o in objs:
+        pool.return_resource(o)
+    # two running and one queued, the fourth return waits for a free slot
+    assert time.monotonic() - start >= 0.09
+    assert pool.drain(timeout=5)
+    assert max(peak) == 2
+    assert len(pool._available) == 4
+    assert pool.close()
+
+
+def test_pool_callback_user_executor_and_close():
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=1)
+    pool = rp.ResourcePool([Person("John"), Person("Jim")],
+                           return_callback=do_callback_exception,
+                           callback_executor=executor)
+    with pool.get_resource():
+        pass
+    # callback failures still remove the object
+    assert pool.drain(timeout=5)
+    assert len(pool._available) == 1
+    assert pool._records[id(pool._available[0])].removed is False
+
+    pool._return_callback = do_callback_upper
+    with pool.get_resource() as obj:
+        pass
+    assert not pool.drain(timeout=0.1)
+    assert pool.close(timeout=5)
+    # the callback in progress was finished before the object was retired
+    assert obj.name == "JIM"
+    assert len(pool._available) == 0
+    # the executor belongs to the caller so it is still usable
+    assert executor.submit(lambda: 1).result() == 1
+    executor.shutdown()
+
+
+def test_pool_factory_min_max():
+    created = []
+
+    def factory():
+        created.append(Person("Person{}".format(len(created))))
+        return created[-1]
+
+    pool = rp.ResourcePool(factory=factory, min_size=1, max_size=3)
+    assert len(created) == 1
+    assert len(pool._available) == 1
+
+    objs = [pool.get_resource_unmanaged(block=False) for i in range(3)]
+    assert objs == created
+    # at max_size, so no more are created
+    assert pool.get_resource_unmanaged(block=False) is None
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resource_unmanaged(timeout=0.1)
+
+    # removing an object makes room for a new one rather than voiding the pool
+    for o in objs:
+        pool.remove(o)
+    with pool.get_resource() as obj:
+        assert obj is created[3]
+
+    # objects added by hand count towards max_size
+    pool.add([Person("Jim"), Person("Jake")])
+    objs = [pool.get_resource_unmanaged(block=False) for i in range(3)]
+    assert [o.name for o in objs] == ["Person3", "Jim", "Jake"]
+    assert pool.get_resource_unmanaged(block=False) is None
+    assert len(created) == 4
+
+
+def test_pool_factory_outside_lock():
+    def slow_factory():
+        time.sleep(0.3)
+        return Person("Slow")
+
+    pool = rp.ResourcePool([Person("John")], factory=slow_factory, max_size=2)
+    john = pool.get_resource_unmanaged()
+    t = Thread(target=pool.get_resource_unmanaged)
+    t.start()
+    time.sleep(0.05)
+    # the slow creation in the other thread doesn't stop us returning and
+    # getting an object
+    start = time.monotonic()
+    pool.return_resource(john)
+    assert pool.get_resource_unmanaged() is john
+    assert time.monotonic() - start < 0.2
+    t.join()
+
+
+def test_pool_factory_failure():
+    def bad_factory():
+        raise ValueError("can't connect")
+
+    pool = rp.ResourcePool(factory=bad_factory, max_size=1)
+    with pytest.raises(ValueError):
+        pool.get_resource_unmanaged()
+    assert pool._creating == 0
+    assert not pool.all_removed()
+
+    with pytest.raises(ValueError):
+        rp.ResourcePool(min_size=1)
+    with pytest.raises(ValueError):
+        rp.ResourcePool(factory=bad_factory, min_size=2, max_size=1)
+
+
+def test_pool_idle_eviction():
+    destroyed = []
+    created = []
+
+    def factory():
+        created.append(Person("Person{}".format(len(created))))
+        return created[-1]
+
+    pool = rp.ResourcePool(factory=factory, min_size=1, max_size=4,
+                           idle_timeout=0.2, destroy=destroyed.append,
+                           reaper_interval=0.05)
+    objs = [pool.get_resource_unmanaged() for i in range(4)]
+    for o in objs[:3]:
+        pool.return_resource(o)
+    time.sleep(0.4)
+    # shrunk back to the floor of one object, which is the checked out
+    # object as that is never evicted
+    assert len(destroyed) == 3
+    assert objs[3] not in destroyed
+    assert pool._active == 1
+    assert len(pool._available) == 0
+
+    pool.return_resource(objs[3])
+    time.sleep(0.4)
+    assert pool._active == 1
+    assert pool._available[0] is objs[3]
+    pool.close()
+
+
+def test_pool_max_uses_and_lifetime():
+    destroyed = []
+    pool = rp.ResourcePool([Person("John"), Person("Jim")], max_uses=2,
+                           destroy=destroyed.append)
+    john = pool._available[0]
+    for i in range(2):
+        with pool.get_resource() as x:
+            assert x is john
+        with pool.get_resource():
+            pass
+    assert destroyed == [john]
+    # without a factory the last object is kept
+    assert pool._active == 1
+    assert len(pool._available) == 1
+
+    pool = rp.ResourcePool(factory=lambda: Person("New"), min_size=2,
+                           max_lifetime=0.2, destroy=destroyed.append,
+                           reaper_interval=0.05)
+    old = list(pool._available)
+    with pool.get_resource() as x:
+        time.sleep(0.3)
+    # the checked out object is retired when it comes back, the idle one by
+    # the reaper, and the pool is topped back up
+    assert x in destroyed
+    time.sleep(0.2)
+    assert all(o in destroyed for o in old)
+    assert pool._active == 2
+    assert not any(o in pool._available for o in old)
+    pool.close()
+
+
+def test_pool_reaper_does_not_keep_pool_alive():
+    import gc
+    pool = rp.ResourcePool([Person("John")], idle_timeout=10,
+                           reaper_interval=0.05)
+    reaper = pool._reaper
+    del pool
+    gc.collect()
+    reaper.join(1)
+    assert not reaper.is_alive()
+
+
+def test_pool_get_resources(pool):
+    with pool.get_resources(3) as objs:
+        assert [o.name for o in objs] == ["John", "Jim", "Jake"]
+        assert len(pool._available) == 1
+        # not enough for another three
+        with pool.get_resources(3, block=False) as more:
+            assert more is None
+        with pytest.raises(rp.ResourceTimeout):
+            pool.get_resources_unmanaged(2, timeout=0.1)
+        # nothing was held while waiting
+        assert len(pool._available) == 1
+    assert len(pool._available) == 4
+
+    with pytest.raises(ValueError):
+        pool.get_resources_unmanaged(0)
+
+
+def test_pool_get_resources_waits_for_all(pool):
+    held = pool.get_resources_unmanaged(3)
+    got = []
+    t = Thread(target=lambda: got.append(pool.get_resources_unmanaged(2)))
+    t.start()
+    time.sleep(0.05)
+    # the batch waiter doesn't take the single object left in the pool, and a
+    # single object waiter isn't starved by it
+    assert len(pool._available) == 1
+    with pool.get_resource(timeout=1):
+        pass
+    pool.return_resource(held[0])
+    t.join(1)
+    assert len(got) == 1 and len(got[0]) == 2
+    pool.return_resources(got[0] + held[1:])
+    assert len(pool._available) == 4
+
+
+def test_pool_return_resources_callbacks_one_dispatch(pool_with_callback_ok):
+    pool = pool_with_callback_ok
+    objs = pool.get_resources_unmanaged(3)
+    objs[2].resource_pool_return_callback = do_callback_lower
+    start = time.monotonic()
+    pool.return_resources(objs)
+    assert time.monotonic() - start < 0.5
+    assert pool._callbacks_in_flight == 1
+    assert pool.drain(timeout=5)
+    # run one after the other by a single worker
+    assert time.monotonic() - start >= 3
+    assert [o.name for o in objs] == ["JOHN", "JIM", "jake"]
+    assert len(pool._available) == 4
+
+
+def test_pool_get_resources_factory():
+    pool = rp.ResourcePool([Person("John")], factory=lambda: Person("New"),
+                           max_size=3)
+    with pool.get_resources(3) as objs:
+        assert [o.name for o in objs] == ["John", "New", "New"]
+        assert pool.get_resources_unmanaged(1, block=False) is None
+    assert len(pool._available) == 3
+
+
+def test_pool_stats(pool_with_callback_exception):
+    pool = pool_with_callback_exception
+    stats = pool.stats()
+    assert stats['size'] == 4
+    assert stats['available'] == 4
+    assert 'wait_time' not in stats
+
+    objs = pool.get_resources_unmanaged(3)
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resources_unmanaged(2, timeout=0.01)
+    t = Thread(target=pytest.raises, args=(rp.ResourceTimeout,
+                                           pool.get_resources_unmanaged, 2),
+               kwargs={'timeout': 0.2})
+    t.start()
+    time.sleep(0.05)
+    stats = pool.stats()
+    assert stats['checked_out'] == 3
+    assert stats['waiters'] == 1
+    t.join()
+
+    pool.return_resource(objs[0])
+    assert pool.drain(timeout=5)
+    stats = pool.stats()
+    assert stats == {'size': 3, 'available': 1, 'checked_out': 2,
+                     'in_callback': 0, 'removed': 1, 'waiters': 0,
+                     'acquires': 3, 'timeouts': 2, 'callback_failures': 1,
+                     'rejected': 0}
+
+
+def test_pool_metrics_and_listeners():
+    from pyresourcepool.metrics import PoolListener
+
+    class Recorder(PoolListener):
+        def __init__(self):
+            self.events = []
+
+        def on_acquire(self, pool, obj, wait):
+            self.events.append(('acquire', obj.name))
+
+        def on_return(self, pool, obj, hold):
+            assert hold >= 0.1
+            self.events.append(('return', obj.name))
+
+        def on_remove(self, pool, obj):
+            self.events.append(('remove', obj.name))
+
+        def on_callback_complete(self, pool, obj, duration, error):
+            self.events.append(('callback', obj.name, type(error)))
+
+    pool = rp.ResourcePool([Person("John"), Person("Jim"), Person("Jake")],
+                           return_callback=do_callback_exception, metrics=True)
+    recorder = Recorder()
+    pool.add_listener(recorder)
+    with pool.get_resource():
+        time.sleep(0.1)
+    assert pool.drain(timeout=5)
+    with pool.get_resource() as obj:
+        pool.remove(obj)
+        time.sleep(0.1)
+    assert recorder.events == [('acquire', 'John'), ('return', 'John'),
+                               ('callback', 'John', ValueError),
+                               ('remove', 'John'), ('acquire', 'Jim'),
+                               ('remove', 'Jim'), ('return', 'Jim')]
+
+    stats = pool.stats()
+    assert stats['wait_time']['count'] == 2
+    assert stats['hold_time']['count'] == 2
+    assert 0.1 <= stats['hold_time']['p50'] <= stats['hold_time']['max']
+    assert stats['callback_time']['count'] == 1
+
+    pool.remove_listener(recorder)
+    assert pool._instrumented
+
+
+def test_histogram_percentiles():
+    from pyresourcepool.metrics import Histogram
+    h = Histogram()
+    assert h.snapshot()['p50'] is None
+    for i in range(1, 1001):
+        h.record(i / 1000.0)
+    snapshot = h.snapshot()
+    assert snapshot['count'] == 1000
+    assert snapshot['min'] == 0.001 and snapshot['max'] == 1.0
+    assert abs(snapshot['p50'] - 0.5) < 0.05
+    assert abs(snapshot['p99'] - 0.99) < 0.1
+
+    other = Histogram()
+    other.record(2.0)
+    h.merge(other)
+    h.merge(Histogram())
+    assert h.count == 1001 and h.max == 2.0 and h.min == 0.001
+    assert h.percentile(100) == 2.0
+
+
+def is_healthy(obj):
+    if obj.name == "Broken":
+        return False
+    if obj.name == "Error":
+        raise ValueError("connection lost")
+    return True
+
+
+def test_pool_validate_on_borrow():
+    replaced = []
+
+    def replace(old):
+        replaced.append(old)
+        return Person("New" + str(len(replaced)))
+
+    objs = [Person("Broken"), Person("Error"), Person("John")]
+    pool = rp.ResourcePool(objs, validate=is_healthy, replace=replace)
+    with pool.get_resource() as obj:
+        assert obj.name == "John"
+    assert replaced == objs[:2]
+    assert [o.name for o in pool._available] == ["New1", "New2", "John"]
+    assert pool.stats()['removed'] == 2
+
+    # every object failing without a replacement empties the pool
+    pool = rp.ResourcePool([Person("Broken")], validate=is_healthy)
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.get_resource_unmanaged()
+
+    # batches only ever contain healthy objects
+    pool = rp.ResourcePool([Person("John"), Person("Broken"), Person("Jim"),
+                            Person("Jake")], validate=is_healthy)
+    with pool.get_resources(3) as objs:
+        assert [o.name for o in objs] == ["Jake", "John", "Jim"]
+
+
+def test_pool_validate_idle_time():
+    checked = []
+
+    def validate(obj):
+        checked.append(obj)
+        return True
+
+    pool = rp.ResourcePool([Person("John")], validate=validate,
+                           validate_idle_time=0.2)
+    for i in range(3):
+        with pool.get_resource():
+            pass
+    assert checked == []
+    time.sleep(0.25)
+    with pool.get_resource():
+        pass
+    assert len(checked) == 1
+
+
+def test_pool_validate_on_return_and_periodically():
+    pool = rp.ResourcePool([Person("John"), Person("Jim"), Person("Jake")],
+                           validate=is_healthy, validate_on_borrow=False,
+                           validate_on_return=True, validate_interval=0.1)
+    with pool.get_resource() as obj:
+        obj.name = "Broken"
+    assert pool.drain(timeout=5)
+    assert obj not in pool._available
+    assert id(obj) not in pool._records
+
+    pool._available[0].name = "Error"
+    time.sleep(0.3)
+    assert len(pool._available) == 1
+    assert pool._available[0].name == "Jake"
+    pool.close()
+
+
+def start_waiter(p, order, name, **kwargs):
+    """ start a thread that waits for a resource and records when it got it """
+    def wait():
+        obj = p.get_resource_unmanaged(**kwargs)
+        order.append((name, obj))
+    t = Thread(target=wait)
+    t.start()
+    # give it time to queue up
+    time.sleep(0.02)
+    return t
+
+
+def test_fair_pool_fifo_and_priority():
+    pool = rp.ResourcePool([Person("John"), Person("Jim")], fair=True)
+    objs = [pool.get_resource_unmanaged() for i in range(2)]
+    order = []
+    threads = [start_waiter(pool, order, "first"),
+               start_waiter(pool, order, "second"),
+               start_waiter(pool, order, "urgent", priority=10),
+               start_waiter(pool, order, "third")]
+    assert pool.stats()['waiters'] == 4
+
+    pool.return_resource(objs[0])
+    pool.return_resource(objs[1])
+    # handed straight to the head of the queue, nobody can barge in
+    assert pool.get_resource_unmanaged(block=False) is None
+    time.sleep(0.05)
+    assert order == [("urgent", objs[0]), ("first", objs[1])]
+
+    pool.return_resources([o for name, o in order])
+    for t in threads:
+        t.join(1)
+    assert [name for name, o in order[2:]] == ["second", "third"]
+
+
+def test_fair_pool_timeout_and_batches():
+    pool = rp.ResourcePool([Person("John"), Person("Jim")], fair=True)
+    held = pool.get_resources_unmanaged(2)
+    got = []
+    t = Thread(target=lambda: got.append(pool.get_resources_unmanaged(2)))
+    t.start()
+    time.sleep(0.02)
+    # a single object waiter queued behind the batch doesn't jump it
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resource_unmanaged(timeout=0.1)
+    pool.return_resource(held[0])
+    with pytest.raises(rp.ResourceTimeout):
+        pool.get_resource_unmanaged(timeout=0.1)
+    pool.return_resource(held[1])
+    t.join(1)
+    assert len(got[0]) == 2
+    assert pool._queue == []
+    assert pool.stats()['timeouts'] == 2
+
+
+def test_fair_pool_all_removed_wakes_waiters():
+    pool = rp.ResourcePool([Person("John")], fair=True)
+    john = pool.get_resource_unmanaged()
+    errors = []
+
+    def wait():
+        with pytest.raises(rp.AllResourcesRemoved):
+            pool.get_resource_unmanaged(timeout=5)
+        errors.append(True)
+    t = Thread(target=wait)
+    t.start()
+    time.sleep(0.05)
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.remove(john)
+    t.join(1)
+    assert errors == [True]
+
+
+def names(pool, n):
+    """ get 'n' resources one at a time and return them in reverse order """
+    objs = [pool.get_resource_unmanaged() for i in range(n)]
+    for o in reversed(objs):
+        pool.return_resource(o)
+    return [o.name for o in objs]
+
+
+def test_pool_strategies():
+    people = [Person("John"), Person("Jim"), Person("Jake")]
+    pool = rp.ResourcePool(people, strategy='lifo')
+    assert names(pool, 2) == ["Jake", "Jim"]
+    # the last returned was Jake
+    assert names(pool, 1) == ["Jake"]
+
+    pool = rp.ResourcePool(people, strategy='fifo')
+    assert names(pool, 2) == ["John", "Jim"]
+    # returned Jim then John, Jake has been waiting longest
+    assert names(pool, 3) == ["Jake", "Jim", "John"]
+
+    pool = rp.ResourcePool(people, strategy='lru')
+    assert names(pool, 2) == ["John", "Jim"]
+    # Jake has never been handed out, then John was handed out before Jim
+    # even though it was returned after it
+    assert names(pool, 3) == ["Jake", "John", "Jim"]
+    pool.remove(people[2])
+    assert names(pool, 2) == ["John", "Jim"]
+
+
+def test_pool_affinity_strategy():
+    people = [Person("John"), Person("Jim"), Person("Jake")]
+    pool = rp.ResourcePool(people, strategy='affinity')
+    with pool.get_resource(key="tenant1") as x:
+        assert x.name == "John"
+    with pool.get_resource(key="tenant2") as x:
+        assert x.name == "Jim"
+    with pool.get_resource(key="tenant1") as x:
+        assert x.name == "John"
+    with pool.get_resource(key="tenant2") as x:
+        assert x.name == "Jim"
+    # no match, oldest available
+    with pool.get_resource(key="tenant3") as x:
+        assert x.name == "Jake"
+    with pool.get_resource() as x:
+        assert x.name == "John"
+    # John is still tenant1's after being handed out without a key
+    with pool.get_resource(key="tenant1") as x:
+        assert x.name == "John"
+    # Jake has been handed out for tenant2 now
+    with pool.get_resources(2, key="tenant2") as objs:
+        assert [o.name for o in objs] == ["Jim", "Jake"]
+    with pool.get_resource(key="tenant3") as x:
+        assert x.name == "John"
+
+    pool.remove(people[0])
+    assert id(people[0]) not in pool._available._keys
+    assert len(pool._available) == 2
+    assert pool._available._by_key.keys() == {"tenant2"}
+
+
+def test_pool_custom_strategy():
+    from pyresourcepool.strategies import FifoStrategy
+
+    class Shortest(FifoStrategy):
+        def take(self, key=None):
+            obj = min(self, key=lambda o: len(o.name))
+            self.discard(obj)
+            return obj
+
+    pool = rp.ResourcePool([Person("Jason"), Person("Jim"), Person("Jake")],
+                           strategy=Shortest())
+    assert names(pool, 3) == ["Jim", "Jake", "Jason"]
+
+
+def test_pool_track_checkouts():
+    pool = rp.ResourcePool([Person("John"), Person("Jim")], track_checkouts=True,
+                           capture_stack=True)
+    assert pool.checked_out() == []
+    held = []
+    t = Thread(target=lambda: held.append(pool.get_resource_unmanaged()),
+               name="leaky-worker")
+    t.start()
+    t.join()
+    with pool.get_resource() as obj:
+        checked_out = pool.checked_out()
+        assert [c['resource'] for c in checked_out] == [held[0], obj]
+        assert checked_out[0]['thread'] == "leaky-worker"
+        assert checked_out[0]['held'] >= checked_out[1]['held']
+        assert checked_out[1]['stack'][-1].name == "test_pool_track_checkouts"
+    assert [c['resource'] for c in pool.checked_out()] == held
+
+
+def test_pool_max_hold_time():
+    from pyresourcepool.metrics import PoolListener
+
+    class Recorder(PoolListener):
+        leaks = []
+
+        def on_leak(self, pool, obj, held):
+            self.leaks.append(obj.name)
+
+    # the reaper is slow enough to not get in the way, _reap() is run here
+    pool = rp.ResourcePool([Person("John"), Person("Jim")], max_hold_time=0.1,
+                           reaper_interval=60)
+    pool.add_listener(Recorder())
+    obj = pool.get_resource_unmanaged()
+    pool._reap()
+    assert Recorder.leaks == []
+    time.sleep(0.15)
+    with pytest.warns(rp.ResourceLeakWarning, match="held by thread MainThread"):
+        pool._reap()
+    assert Recorder.leaks == ["John"]
+    # only reported once per checkout
+    pool._reap()
+    assert Recorder.leaks == ["John"]
+    pool.return_resource(obj)
+    assert pool.checked_out() == []
+
+
+def test_pool_lease():
+    import gc
+    pool = rp.ResourcePool([Person("John")])
+    with pool.lease() as lease:
+        assert lease.resource.name == "John"
+        assert pool.lease(block=False) is None
+    lease.release()
+    assert len(pool._available) == 1
+
+    lease = pool.lease()
+    assert pool.stats()['available'] == 0
+    with pytest.warns(rp.ResourceLeakWarning, match="never returned"):
+        del lease
+        gc.collect()
+    assert pool.stats()['available'] == 1
+
+
+def test_pool_warmup():
+    def warmup(obj):
+        if obj.name == "Jake":
+            raise ValueError("can't connect")
+        time.sleep(0.2 if obj.name == "John" else 0.5)
+        obj.name = obj.name.upper()
+
+    start = time.monotonic()
+    pool = rp.ResourcePool([Person("John"), Person("Jim"), Person("Jake")],
+                           warmup=warmup, callback_workers=3)
+    # the constructor doesn't wait for the warm-ups
+    assert time.monotonic() - start < 0.1
+    assert pool.wait_ready(0) is True
+    # the first object ready is handed out while the others warm up
+    with pool.get_resource(timeout=5) as obj:
+        assert obj.name == "JOHN"
+        assert time.monotonic() - start < 0.4
+    assert pool.wait_ready(2, timeout=5) is True
+    # Jake failed so they can't all be ready
+    assert pool.wait_ready(timeout=5) is False
+    assert pool.wait_ready(3) is False
+    stats = pool.stats()
+    assert stats['size'] == 2 and stats['callback_failures'] == 1
+    assert names(pool, 2) == ["JOHN", "JIM"]
+
+    # without a warm-up every object is ready straight away
+    assert rp.ResourcePool([Person("John")]).wait_ready(timeout=0) is True
+
+
+class Empty(object):
+    def __len__(self):
+        return 0
+
+
+def test_pool_falsy_resources():
+    falsy = [0, [], Empty()]
+    pool = rp.ResourcePool(falsy)
+    got = []
+    for i in range(3):
+        with pool.get_resource() as obj:
+            got.append(obj)
+    assert got == falsy
+    obj = pool.get_resource_unmanaged()
+    assert obj == 0
+    pool.return_resource(obj)
+    assert pool.stats()['available'] == 3
+    with pytest.raises(ValueError):
+        pool.add(None)
+
+
+def test_pool_records_bounded():
+    pool = rp.ResourcePool([Person("John")])
+    for i in range(100):
+        obj = Person(str(i))
+        pool.add(obj)
+        pool.remove(obj)
+    assert len(pool._records) == 1
+
+    # a removed object that is checked out is dropped once it's returned
+    obj = Person("Jim")
+    pool.add(obj)
+    pool.get_resource_unmanaged()
+    obj = pool.get_resource_unmanaged()
+    pool.remove(obj)
+    assert len(pool._records) == 2
+    pool.return_resource(obj)
+    assert len(pool._records) == 1
+
+
+@pytest.mark.parametrize('fair', [False, True])
+def test_pool_max_waiters(fair):
+    pool = rp.ResourcePool([Person("John")], max_waiters=1, fair=fair)
+    obj = pool.get_resource_unmanaged()
+    got = []
+    t = Thread(target=lambda: got.append(pool.get_resource_unmanaged(timeout=5)))
+    t.start()
+    time.sleep(0.1)
+    with pytest.raises(rp.PoolExhausted):
+        pool.get_resource_unmanaged(timeout=5)
+    # not waiting, so not turned away
+    assert pool.get_resource_unmanaged(block=False) is None
+    pool.return_resource(obj)
+    t.join(5)
+    assert got == [obj]
+    assert pool.stats()['rejected'] == 1
+
+
+def test_pool_circuit_breaker():
+    def callback(obj):
+        if obj.name.startswith("bad"):
+            raise ValueError("downstream is down")
+
+    people = [Person("bad%d" % i) for i in range(3)] + [Person("John")]
+    pool = rp.ResourcePool(people, return_callback=callback, breaker_failure_rate=0.5,
+                           breaker_window=2, breaker_cooldown=0.3)
+    assert pool.circuit_state() == 'closed'
+    objs = pool.get_resources_unmanaged(4)
+    waiter = Thread(target=pytest.raises, args=(rp.CircuitOpen,
+                                                pool.get_resource_unmanaged),
+                    kwargs={'timeout': 5})
+    waiter.start()
+    time.sleep(0.1)
+    pool.return_resource(objs[0])
+    pool.return_resource(objs[1])
+    assert pool.drain(timeout=5)
+    # two failures out of two, the waiter was woken and turned away
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert pool.circuit_state() == 'open'
+    with pytest.raises(rp.CircuitOpen):
+        pool.get_resource_unmanaged(block=False)
+    assert issubclass(rp.CircuitOpen, rp.PoolExhausted)
+    assert pool.stats()['rejected'] == 2
+
+    time.sleep(0.35)
+    assert pool.circuit_state() == 'half_open'
+    # a failure while half open opens it again straight away
+    pool.return_resource(objs[2])
+    assert pool.drain(timeout=5)
+    assert pool.circuit_state() == 'open'
+    time.sleep(0.35)
+    # and a success closes it
+    pool.return_resource(objs[3])
+    assert pool.drain(timeout=5)
+    assert pool.circuit_state() == 'closed'
+    with pool.get_resource(block=False) as obj:
+        assert obj.name == "John"
+
+
+def test_pool_shrink():
+    destroyed = []
+    people = [Person(name) for name in ("John", "Jim", "Jake", "Jane")]
+    pool = rp.ResourcePool(people, destroy=destroyed.append)
+    john = pool.get_resource_unmanaged()
+    jim = pool.get_resource_unmanaged()
+    # idle objects go first, then the checked out ones when they come back
+    assert pool.shrink(3, destroy=lambda o: destroyed.append(o.name)) == 3
+    assert destroyed == ["Jake", "Jane"]
+    assert pool.size() == 1
+    assert pool.stats()['size'] == 2
+    pool.return_resources([john, jim])
+    assert len(destroyed) == 3 and destroyed[2] in ("John", "Jim")
+    assert pool.stats()['size'] == 1
+    assert len(pool._records) == 1
+    # the last object isn't taken and shrink() doesn't raise
+    assert pool.shrink(5) == 0
+    assert names(pool, 1) == [({"John", "Jim"} - set(destroyed)).pop()]
+
+
+def test_pool_resize():
+    created = []
+
+    def factory():
+        created.append(Person("Person{}".format(len(created))))
+        return created[-1]
+
+    pool = rp.ResourcePool(factory=factory, min_size=2, max_size=3)
+    assert pool.resize(5) == 3
+    assert pool.stats()['available'] == 5
+    assert pool.resize(1) == -4
+    assert pool.stats()['size'] == 1
+    # doesn't grow back beyond the new size
+    pool.get_resource_unmanaged()
+    assert pool.get_resource_unmanaged(block=False) is None
+
+    pool = rp.ResourcePool([Person("John"), Person("Jim")])
+    with pytest.raises(ValueError):
+        pool.resize(3)
+    assert pool.resize(1) == -1
+    assert pool.size() == 1
+
+
+def test_pool_autoscale():
+    created = []
+
+    def factory():
+        created.append(Person("Person{}".format(len(created))))
+        return created[-1]
+
+    pool = rp.ResourcePool(factory=factory, min_size=1, max_size=8,
+                           autoscale_interval=0.1, reaper_interval=0.05)
+    obj = pool.get_resource_unmanaged()
+    # the only object is in use, so the pool grows ahead of demand
+    time.sleep(0.4)
+    assert pool.size() == 2
+    assert pool.stats()['available'] == 1
+    assert len(created) == 2
+    pool.return_resource(obj)
+    # nothing in use, so it shrinks back down to min_size
+    time.sleep(0.4)
+    assert pool.size() == 1
+    pool.close()
+
+    with pytest.raises(ValueError):
+        rp.ResourcePool([Person("John")], autoscale_interval=1)
+
+
+def test_pool_close():
+    destroyed = []
+    callbacks = []
+
+    def slow_callback(obj):
+        time.sleep(0.3)
+        callbacks.append(obj.name)
+
+    john, jim, jake = Person("John"), Person("Jim"), Person("Jake")
+    pool = rp.ResourcePool([john, jim, jake], destroy=destroyed.append,
+                           return_callback=slow_callback)
+    pool.get_resources_unmanaged(3)
+    pool.return_resource(jake)
+    waiter = Thread(target=pytest.raises, args=(rp.PoolClosed,
+                                                pool.get_resource_unmanaged))
+    waiter.start()
+    time.sleep(0.1)
+
+    result = []
+    closer = Thread(target=lambda: result.append(pool.close(timeout=5)))
+    closer.start()
+    # the waiter is woken with PoolClosed
+    waiter.join(5)
+    assert not waiter.is_alive()
+    with pytest.raises(rp.PoolClosed):
+        pool.get_resource_unmanaged(block=False)
+    with pytest.raises(rp.PoolClosed):
+        pool.add(Person("Jane"))
+    # close() waits for Jake's callback and the objects still checked out
+    time.sleep(0.4)
+    assert closer.is_alive()
+    assert destroyed == [jake]
+    pool.return_resources([john, jim])
+    closer.join(5)
+    assert result == [True]
+    # the callbacks of the objects returned after close() were skipped
+    assert callbacks == ["Jake"]
+    assert sorted(o.name for o in destroyed) == ["Jake", "Jim", "John"]
+    assert pool.stats()['size'] == 0
+
+    # a pool used in a 'with' statement is closed at the end of it
+    destroyed = []
+    with rp.ResourcePool([Person("John")], destroy=destroyed.append) as pool:
+        with pool.get_resource() as obj:
+            pass
+    assert destroyed == [obj]
+    assert pool.close(timeout=0)
+
+
+class Slotted(object):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+def test_pool_lease_options():
+    destroyed = []
+    john, jim = Slotted("John"), Slotted("Jim")
+    pool = rp.ResourcePool([john, jim], destroy=destroyed.append,
+                           replace=lambda old: Slotted(old.name + "2"))
+    # a callback for one checkout, on an object that can't take attributes
+    with pool.get_resource(lease=True) as lease:
+        assert lease.resource is john
+        lease.metadata['request'] = 1
+        lease.on_return(lambda o: setattr(o, 'name', o.name.upper()))
+    assert pool.drain(timeout=5)
+    assert john.name == "JOHN"
+    # the next checkout of the same object doesn't run it again
+    with pool.lease() as lease:
+        assert lease.resource is jim
+    with pool.get_resource(lease=True) as lease:
+        assert lease.resource is john
+    assert pool.drain(timeout=5)
+    assert john.name == "JOHN"
+
+    # a discarded resource is destroyed and replaced instead of returned
+    with pool.get_resource(lease=True) as lease:
+        lease.discard()
+    assert destroyed == [jim]
+    assert sorted(names(pool, 2)) == ["JOHN", "Jim2"]
+    assert pool.stats()['size'] == 2
+
+    with pool.get_resources(2):
+        with pool.get_resource(lease=True, block=False) as lease:
+            assert lease is None
+
+
+def test_pool_snapshot_restore(tmp_path):
+    people = dict((name, Person(name)) for name in ("John", "Jim", "Jake", "Jane"))
+    pool = rp.ResourcePool(list(people.values()))
+    john = pool.get_resource_unmanaged()
+    pool.return_resource(john)
+    jim = pool.get_resource_unmanaged()
+    jake = pool.get_resource_unmanaged()
+    pool.remove(jake)
+    pool.remove(people["Jane"])
+    path = str(tmp_path / "pool.json")
+    snapshot = pool.snapshot(lambda o: o.name, path=path)
+    assert [(o['id'], o['state'], o['uses']) for o in snapshot['objects']] == [
+        ("John", 'available', 1), ("Jim", 'out', 1), ("Jake", 'removed', 1)]
+
+    reset = []
+    warmed = []
+    restored = rp.ResourcePool.restore(path, people.get, return_callback=reset.append,
+                                       warmup=warmed.append)
+    assert restored.drain(timeout=5)
+    # only the object that was out is reset, nothing is warmed up again
+    assert reset == [jim]
+    assert warmed == []
+    assert restored.stats()['size'] == 2
+    assert restored._records[id(john)].use_count == 1
+    assert names(restored, 2) == ["John", "Jim"]
+
+    # gone objects are skipped and the pool is topped up to min_size
+    restored = rp.ResourcePool.restore(snapshot, {"John": john}.get,
+                                       factory=lambda: Person("New"), min_size=2)
+    assert sorted(names(restored, 2)) == ["John", "New"]
+    with pytest.raises(ValueError):
+        rp.ResourcePool.restore(snapshot, people.get, min_size=2)
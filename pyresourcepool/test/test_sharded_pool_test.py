@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import pytest
+from threading import Lock, Thread
+import time
+import pyresourcepool.pyresourcepool as rp
+from pyresourcepool.shardedpool import ShardedResourcePool
+
+
+class Person(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def test_sharded_pool_steals_from_other_stripes():
+    p = ShardedResourcePool([Person("John")], stripes=4)
+    got = []
+
+    def take():
+        # each thread has its own home stripe, only one holds the object
+        with p.get_resource(block=False) as obj:
+            got.append(obj)
+    for i in range(4):
+        t = Thread(target=take)
+        t.start()
+        t.join()
+    assert [o.name for o in got] == ["John"] * 4
+    assert p.stats()['available'] == 1
+
+
+def test_sharded_pool_waits_and_times_out():
+    p = ShardedResourcePool([Person("John")], stripes=2)
+    obj = p.get_resource_unmanaged()
+    with pytest.raises(rp.ResourceTimeout):
+        p.get_resource_unmanaged(timeout=0.1)
+    assert p.get_resource_unmanaged(block=False) is None
+
+    got = []
+    t = Thread(target=lambda: got.append(p.get_resource_unmanaged(timeout=5)))
+    t.start()
+    time.sleep(0.1)
+    assert p.stats()['waiters'] == 1
+    p.return_resource(obj)
+    t.join(5)
+    assert got == [obj]
+
+
+def test_sharded_pool_remove_and_callback():
+    john, jim = Person("John"), Person("Jim")
+    p = ShardedResourcePool([john, jim], stripes=2,
+                            return_callback=lambda o: setattr(o, 'name', o.name.upper()))
+    with pytest.raises(rp.ObjectAlreadyInPool):
+        p.add(john)
+    obj = p.get_resource_unmanaged()
+    p.remove(jim)
+    if obj is jim:
+        # returning a removed object doesn't put it back
+        p.return_resource(obj, force=True)
+        obj = p.get_resource_unmanaged()
+    assert obj is john
+    p.return_resource(obj)
+    p.close()
+    assert john.name == "JOHN"
+    assert p.stats()['size'] == 1
+    with pytest.raises(rp.AllResourcesRemoved):
+        p.remove(john)
+    with pytest.raises(rp.AllResourcesRemoved):
+        p.get_resource_unmanaged()
+
+
+def test_sharded_pool_many_threads():
+    objects = [Person(str(i)) for i in range(4)]
+    p = ShardedResourcePool(objects, stripes=4)
+    held = set()
+    held_lock = Lock()
+    errors = []
+
+    def worker():
+        for i in range(500):
+            with p.get_resource(timeout=5) as obj:
+                with held_lock:
+                    if id(obj) in held:
+                        errors.append(obj)
+                    held.add(id(obj))
+                with held_lock:
+                    held.discard(id(obj))
+    threads = [Thread(target=worker) for i in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert p.stats()['available'] == 4
+
+
+def test_sharded_pool_falsy_resources_and_churn():
+    p = ShardedResourcePool([0, []], stripes=2)
+    with p.get_resource() as a:
+        with p.get_resource() as b:
+            assert sorted([a, b], key=repr) == [0, []]
+    assert p.stats()['available'] == 2
+    for i in range(100):
+        obj = Person(str(i))
+        p.add(obj)
+        p.remove(obj)
+    assert len(p._records) == 2
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import pytest
+import pyresourcepool.pyresourcepool as rp
+
+sharedpool = pytest.importorskip("pyresourcepool.sharedpool")
+if sharedpool.shared_memory is None:
+    pytest.skip("needs multiprocessing.shared_memory", allow_module_level=True)
+
+
+@pytest.fixture
+def pool():
+    p = sharedpool.SharedResourcePool(2, reclaim_interval=0.1,
+                                      context=multiprocessing.get_context('spawn'))
+    yield p
+    p.unlink()
+
+
+def hold_and_report(pool, queue, leak):
+    token = pool.get_resource_unmanaged(timeout=5)
+    queue.put(token)
+    if leak:
+        # die without returning the token, once the token is sent
+        queue.close()
+        queue.join_thread()
+        os._exit(0)
+    pool.return_resource(token)
+    pool.close()
+
+
+def test_shared_pool_tokens(pool):
+    with pool.get_resource() as t1:
+        with pool.get_resource() as t2:
+            assert sorted([t1, t2]) == [0, 1]
+            assert pool.get_resource_unmanaged(block=False) is None
+            with pytest.raises(rp.ResourceTimeout):
+                pool.get_resource_unmanaged(timeout=0.1)
+            assert pool.stats()['holders'] == {0: os.getpid(), 1: os.getpid()}
+    assert pool.stats()['available'] == 2
+    with pytest.raises(rp.ObjectNotInPool):
+        pool.return_resource(5)
+    with pytest.raises(rp.ObjectNotInPool):
+        # not checked out
+        pool.return_resource(0)
+
+
+def test_shared_pool_remove_add(pool):
+    pool.remove(0)
+    with pool.get_resource() as token:
+        assert token == 1
+    with pytest.raises(rp.ObjectAlreadyInPool):
+        pool.add(1)
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.remove(1)
+    with pytest.raises(rp.AllResourcesRemoved):
+        pool.get_resource_unmanaged()
+    pool.add(0)
+    assert pool.get_resource_unmanaged() == 0
+
+
+def test_shared_pool_other_process_and_reclaim(pool):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    # a process that returns its token
+    p = ctx.Process(target=hold_and_report, args=(pool, queue, False))
+    p.start()
+    queue.get(timeout=30)
+    p.join(30)
+    assert pool.stats()['available'] == 2
+
+    mine = pool.get_resource_unmanaged()
+    # a process that dies holding the other token
+    p = ctx.Process(target=hold_and_report, args=(pool, queue, True))
+    p.start()
+    leaked = queue.get(timeout=30)
+    p.join(30)
+    assert leaked != mine
+    assert pool.stats()['holders'][leaked] == p.pid
+    # the dead process' token is reclaimed by a waiting caller
+    assert pool.get_resource_unmanaged(timeout=5) == leaked